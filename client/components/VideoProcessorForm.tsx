@@ -49,6 +49,7 @@ const MAX_FILE_SIZE = 20; //20 mb
 const ALLOWED_AUDIO_EXTENSIONS = ["wav", "mp3"];
 const ALLOWED_VIDEO_EXTENSIONS = ["mp4", "avi", "mov", "mkv"];
 const POLLING = 15_000; //15 sec
+const API_URL = "http://127.0.0.1:8000";
 export const youtubeRegex =
   /^(?:https?:\/\/)?(?:m\.|www\.)?(?:youtu\.be\/|youtube\.com\/(?:embed\/|v\/|watch\?v=|watch\?.+&v=))((\w|-){11})(?:\S+)?$/;
 const youtubeUrlSchema = z
@@ -146,6 +147,8 @@ export default function VideoProcessor() {
   const [processingProgress, setProcessingProgress] = useState<number>(0);
   const [processingMessage, setProcessingMessage] = useState<string>("");
   const [isProcessing, setIsProcessing] = useState(false);
+  const [taskId, setTaskId] = useState<string | null>(null);
+  const [previewUrl, setPreviewUrl] = useState<string | null>(null);
 
   const form = useForm<FormData>({
     resolver: zodResolver(schema),
@@ -196,46 +199,91 @@ export default function VideoProcessor() {
     }
   }, [youtubeUrl, videoFile, referenceAudio, audioSource]);
 
-  // Add this function to handle SSE events
-  const listenToProgress = (progressId: string) => {
-    const eventSource = new EventSource(`/stream?channel=${progressId}`);
-
-    eventSource.addEventListener("progress", (event) => {
-      const data = JSON.parse(event.data);
-      setProcessingMessage(data.message);
-      setProcessingProgress(data.percentage);
-
-      if (data.percentage === 100) {
+  // Wait for a task to finish, driven by the task's SSE channel. Falls back
+  // to polling /task_status if the event stream is unavailable.
+  const waitForTask = (
+    taskId: string,
+    onProgress: (progress: number, message: string) => void
+  ): Promise<any> =>
+    new Promise((resolve, reject) => {
+      let settled = false;
+      const eventSource = new EventSource(
+        `${API_URL}/stream?channel=${taskId}`
+      );
+
+      const handleState = (data: any) => {
+        if (settled) return;
+        if (data.state === "SUCCESS") {
+          settled = true;
+          eventSource.close();
+          resolve(data.result);
+        } else if (data.state === "FAILURE" || data.state === "CANCELLED") {
+          settled = true;
+          eventSource.close();
+          reject(new Error(taskError(data)));
+        } else if (data.state === "PROGRESS") {
+          onProgress(data.percentage, data.message);
+        }
+        if (data.preview_url) setPreviewUrl(data.preview_url);
+      };
+
+      eventSource.addEventListener("progress", (event) =>
+        handleState(JSON.parse(event.data))
+      );
+      eventSource.addEventListener("success", (event) =>
+        handleState(JSON.parse(event.data))
+      );
+      eventSource.addEventListener("failure", (event) =>
+        handleState(JSON.parse(event.data))
+      );
+      eventSource.addEventListener("cancelled", (event) =>
+        handleState(JSON.parse(event.data))
+      );
+      eventSource.addEventListener("preview", (event) =>
+        handleState(JSON.parse(event.data))
+      );
+
+      eventSource.onerror = () => {
         eventSource.close();
-      }
+        if (!settled) {
+          settled = true;
+          pollTaskStatus(taskId, onProgress).then(resolve, reject);
+        }
+      };
+
+      // Catch up on anything published before the stream was opened
+      fetchTaskStatus(taskId).then(handleState).catch(() => {});
     });
 
-    eventSource.onerror = () => {
-      eventSource.close();
-    };
+  const taskError = (data: any): string => {
+    if (data.rejected) return "Rendering stopped, the preview was rejected";
+    return data.error || "The task was cancelled";
+  };
+
+  // Stop the full render once the preview shows the wrong person
+  const rejectPreview = async () => {
+    if (!taskId) return;
+    await fetch(`${API_URL}/reject/${taskId}`, { method: "POST" });
+  };
 
-    return eventSource;
+  const fetchTaskStatus = async (taskId: string): Promise<any> => {
+    const response = await fetch(`${API_URL}/task_status/${taskId}`);
+    if (!response.ok) {
+      throw new Error("Failed to fetch task status");
+    }
+    return response.json();
   };
 
-  // Add this function near your other utility functions
   const pollTaskStatus = async (
     taskId: string,
     onProgress: (progress: number, message: string) => void
   ): Promise<any> => {
     while (true) {
       try {
-        const response = await fetch(
-          `http://127.0.0.1:8000/task_status/${taskId}`
-        );
-        if (!response.ok) {
-          throw new Error("Failed to fetch task status");
-        }
-
-        const data = await response.json();
-        console.log("Task status:", data); // Add logging
+        const data = await fetchTaskStatus(taskId);
 
-        if (data.state === "FAILURE") {
-          throw new Error(data.error);
+        if (data.state === "FAILURE" || data.state === "CANCELLED") {
+          throw new Error(taskError(data));
         }
 
         if (data.state === "SUCCESS") {
@@ -243,8 +291,9 @@ export default function VideoProcessor() {
         }
 
         if (data.state === "PROGRESS") {
-          onProgress(data.percentage, data.status);
+          onProgress(data.percentage, data.message);
         }
+        if (data.preview_url) setPreviewUrl(data.preview_url);
 
         // Wait before next poll
         await new Promise((resolve) => setTimeout(resolve, POLLING));
@@ -260,6 +309,7 @@ export default function VideoProcessor() {
     setIsProcessing(true);
     setError(null);
     setResult(null);
+    setPreviewUrl(null);
     setProcessingProgress(0);
     setProcessingMessage("Starting process...");
 
@@ -277,7 +327,7 @@ export default function VideoProcessor() {
       }
 
       // Start the processing task
-      const response = await fetch("http://127.0.0.1:8000/process_video", {
+      const response = await fetch(`${API_URL}/process_video`, {
         method: "POST",
         body: formData,
       });
@@ -288,12 +338,19 @@ export default function VideoProcessor() {
       }
 
       const { task_id } = await response.json();
+      setTaskId(task_id);
+
+      // Detach from the task when the user leaves the page. The server only
+      // cancels it once no other submission is attached to it
+      const cancelOnUnload = () =>
+        navigator.sendBeacon(`${API_URL}/cancel/${task_id}`);
+      window.addEventListener("pagehide", cancelOnUnload);
 
-      // Poll for results
-      const result = await pollTaskStatus(task_id, (progress, message) => {
+      // Follow the task's progress events until it finishes
+      const result = await waitForTask(task_id, (progress, message) => {
         setProcessingProgress(progress);
         setProcessingMessage(message);
-      });
+      }).finally(() => window.removeEventListener("pagehide", cancelOnUnload));
 
       if (result.error) {
         throw new Error(result.error);
@@ -627,6 +684,22 @@ export default function VideoProcessor() {
                     <span>{processingProgress}%</span>
                   </div>
                   <Progress value={processingProgress} className="h-2" />
+                  {previewUrl && (
+                    <div className="space-y-2">
+                      <p className="text-sm text-muted-foreground">
+                        Preview (low quality) while the final video renders
+                      </p>
+                      <Player src={previewUrl} />
+                      <Button
+                        type="button"
+                        variant="outline"
+                        onClick={rejectPreview}
+                        className="w-full"
+                      >
+                        Wrong person? Stop rendering
+                      </Button>
+                    </div>
+                  )}
                 </div>
               )}
 
@@ -1,102 +1,69 @@
 from flask import Flask, request, jsonify, Response
 import os
-import yt_dlp
-from pydub import AudioSegment
-from pyannote.audio import Pipeline, Model, Inference
-from scipy.spatial.distance import cdist
-import numpy as np
-from moviepy.editor import VideoFileClip, concatenate_videoclips
 import subprocess
-import boto3
 from werkzeug.utils import secure_filename
 import tempfile
 import uuid
 from flask_cors import CORS
-from dotenv import load_dotenv
 from flask_sse import sse
-import os
-import tempfile
-from concurrent.futures import ThreadPoolExecutor
 import time
 from functools import wraps
 import atexit
-from threading import Thread
-import queue
+from threading import Thread, Condition, Lock
 import redis
-import json
-from setup import (check_redis_installed,
-                   install_redis, start_redis_server,
-                   stop_redis_server, install_ffmpeg)
-import shutil
-import platform
-import torch
-
-
-# Load .env file
-load_dotenv()
-# app = Flask(__name__)
-# CORS(app)
-# app.config["REDIS_URL"] = "redis://localhost"
-# app.register_blueprint(sse, url_prefix='/stream')
-# Configuration
-ALLOWED_AUDIO_EXTENSIONS = {'wav', 'mp3'}
-ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv'}
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
-AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
-AWS_REGION = os.getenv("AWS_REGION")
-HF_TOKEN = os.getenv("HF_TOKEN")
-MAX_CONTENT_LENGTH = 20 * 1024 * 1024  # 20MB max file size
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=AWS_ACCESS_KEY,
-    aws_secret_access_key=AWS_SECRET_KEY,
-    region_name=AWS_REGION
-)
-
-
-def process_tasks(task_queue):
-    """Background thread to process tasks from the queue"""
-    while True:
-        try:
-            task = task_queue.get()
-            if task is None:
-                break
-            task.start()
-            task.join()
-        except Exception as e:
-            print(f"Error processing task: {e}")
+from config import (ALLOWED_AUDIO_EXTENSIONS, ALLOWED_VIDEO_EXTENSIONS,
+                    S3_BUCKET_NAME, REDIS_URL, MATCH_THRESHOLD,
+                    MAX_BATCH_VIDEOS, BATCH_CONCURRENCY, RUN_PREFLIGHT_ON_STARTUP,
+                    START_TASK_PROCESSOR)
+from preflight import run_preflight, check_readiness
+from uploads import claim_upload
+from tasks import (TaskStore, TaskCancelled, TERMINAL_STATES, TASK_TTL,
+                   job_fingerprint, params_fingerprint, task_status_response,
+                   parse_batch_status_request, batch_status_response)
+from scheduler import Scheduler, estimate_job, estimate_render, estimate_embedding
+from artifacts import keep_source, source_path
+from scratch import ScratchSpace, handoff
+from progress import (ProgressRange, DiarizationProgressHook,
+                      probe_duration, run_ffmpeg)
+from render import (SegmentCache, PROFILES, DEFAULT_QUALITY, PREVIEW_PROFILE, render_segments,
+                    stitch_videos, record_cache_stats, cache_stats, source_fingerprint)
+
+
+def start_task_processor(app):
+    """Start the background worker pool of this process
+
+    Threads don't survive a fork, so a preloading server calls this in every
+    worker process instead (see gunicorn.conf.py).
+    """
+    app.scheduler = Scheduler(app.tasks, scratch=app.scratch)
+    app.scheduler.start()
 
 
 def create_app():
     """Create and initialize the Flask application"""
     app = Flask(__name__)
     CORS(app)
-    app.config["REDIS_URL"] = "redis://localhost"
+    app.config["REDIS_URL"] = REDIS_URL
     app.register_blueprint(sse, url_prefix='/stream')
 
     # Initialize dependencies
     with app.app_context():
-        # install ffmpeg
-        install_ffmpeg()
-        # Initialize Redis
-        if not check_redis_installed():
-            install_redis()
-        start_redis_server()
+        # Installing ffmpeg/Redis is slow, so it normally runs ahead of time
+        # through `python preflight.py --install --start-redis`
+        if RUN_PREFLIGHT_ON_STARTUP:
+            run_preflight(install=True, start_redis=True)
 
         # Initialize Redis client
-        app.redis_client = redis.Redis(host='localhost', port=6379, db=0)
+        app.redis_client = redis.Redis.from_url(REDIS_URL)
+        app.tasks = TaskStore(app.redis_client)
+        app.segment_cache = SegmentCache()
+        app.scratch = ScratchSpace()
+        # Jobs of a crashed process never got to remove their directories
+        app.scratch.prune_stale(TASK_TTL)
 
-        # Initialize task queue
-        app.task_queue = queue.Queue()
-
-        # Start the task processor thread
-        app.task_processor = Thread(
-            target=process_tasks, args=(app.task_queue,))
-        # Make thread daemon so it exits when main thread exits
-        app.task_processor.daemon = True
-        app.task_processor.start()
+        app.scheduler = None
+        if START_TASK_PROCESSOR:
+            start_task_processor(app)
 
     return app
 
@@ -125,132 +92,11 @@ def allowed_video_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_VIDEO_EXTENSIONS
 
 
-def upload_to_s3(file_path, bucket, object_name=None):
-    """Upload a file to S3 bucket and return the public URL"""
-    if object_name is None:
-        object_name = os.path.basename(file_path)
-
-    try:
-        s3_client.upload_file(file_path, bucket, object_name)
-        url = f"https://{bucket}.s3.amazonaws.com/{object_name}"
-        return url
-    except Exception as e:
-        print(f"Error uploading to S3: {e}")
-        return None
-
-
-def download_youtube_video(youtube_link, output_path):
-    output_base = os.path.splitext(output_path)[0]
-    actual_output = output_base + '.mp4'
-    error = {
-        "msg": None
-    }
-
-    def yt_filesize_filter(info_dict):
-        size = info_dict.get('filesize') or info_dict.get('filesize_approx', 0)
-        if size > MAX_CONTENT_LENGTH:
-            error['msg'] = "Failed to process Youtube video. Youtube video size is too large"
-        return error['msg']
-    ydl_opts = {
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/mp4',
-        'outtmpl': actual_output,
-        'match_filter': yt_filesize_filter,
-    }
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([youtube_link])
-    return actual_output, error['msg']
-
-
-def extract_audio_from_video(video_path, audio_path):
-    command = f"ffmpeg -i {video_path} -vn -acodec pcm_s16le -ar 44100 -ac 2 {audio_path} -y"
-    subprocess.call(command, shell=True)
-    return audio_path
-
-
-def get_speaker_embedding(audio_path, embedding_model, batch_size=32):
-    inference = Inference(embedding_model, window="whole",
-                          batch_size=batch_size)
-    embedding = inference(audio_path).reshape(1, -1)
-    return embedding
-
-
-def extract_matching_speaker_segments(video_path, diarization_result, matching_speakers, output_path):
-    video = VideoFileClip(video_path)
-    segments = []
-
-    for speech_turn, _, speaker_label in diarization_result.itertracks(yield_label=True):
-        if speaker_label in matching_speakers:
-            start_time = speech_turn.start
-            end_time = speech_turn.end
-            segment = video.subclip(start_time, end_time)
-            segments.append(segment)
-
-    if not segments:
-        video.close()
-        return None
-
-    final_video = concatenate_videoclips(segments)
-    final_video.write_videofile(
-        output_path,
-        codec='libx264',
-        audio_codec='aac',
-        temp_audiofile='temp-audio.m4a',
-        remove_temp=True,
-        threads=4
-    )
-
-    video.close()
-    final_video.close()
-    return output_path
-
-
-def match_speakers(reference_audio, extracted_speakers_dir, threshold=0.3):
-    embedding_model = Model.from_pretrained(
-        "pyannote/embedding", use_auth_token=HF_TOKEN)
-    reference_embedding = get_speaker_embedding(
-        reference_audio, embedding_model)
-
-    matching_speakers = set()
-    distances = {}
-
-    for filename in os.listdir(extracted_speakers_dir):
-        if not filename.endswith('.wav'):
-            continue
-
-        speaker_path = os.path.join(extracted_speakers_dir, filename)
-        speaker_embedding = get_speaker_embedding(
-            speaker_path, embedding_model)
-        distance = cdist(reference_embedding,
-                         speaker_embedding, metric="cosine")[0, 0]
-
-        speaker_label = os.path.splitext(filename)[0]
-        distances[speaker_label] = distance
-
-        if distance <= threshold:
-            matching_speakers.add(speaker_label)
-
-    return matching_speakers, distances
-
-
-def extract_speaker_segments(audio_path, diarization_result, output_dir):
-    audio = AudioSegment.from_wav(audio_path)
-
-    for speech_turn, _, speaker_label in diarization_result.itertracks(yield_label=True):
-        start_time = int(speech_turn.start * 1000)
-        end_time = int(speech_turn.end * 1000)
-
-        segment = audio[start_time:end_time]
-        output_file = os.path.join(output_dir, f"{speaker_label}.wav")
-
-        if not os.path.exists(output_file):
-            segment.export(output_file, format="wav")
-
-
 def validate_inputs(request):
     """Validate the incoming request data"""
     youtube_url = request.form.get('youtube_url')
     video_file = request.files.get('video_file')
+    video_upload_id = request.form.get('video_upload_id')
     reference_audio = request.files.get('reference_audio')
 
     # Check if reference audio is provided and valid
@@ -259,23 +105,79 @@ def validate_inputs(request):
     if not allowed_audio_file(reference_audio.filename):
         return None, 'Invalid audio file format'
 
-    # Check if either YouTube URL or video file is provided (but not both)
-    if youtube_url and video_file:
+    # Check if exactly one of YouTube URL, video file or upload is provided
+    video_sources = [youtube_url, video_file, video_upload_id]
+    if sum(1 for source in video_sources if source) > 1:
         return None, 'Please provide either YouTube URL or video file, not both'
 
-    if not youtube_url and not video_file:
+    if not any(video_sources):
         return None, 'Please provide either YouTube URL or a video file'
 
     if video_file and not allowed_video_file(video_file.filename):
         return None, 'Invalid video file format'
 
+    quality, error = validate_quality(request.form.get('quality'))
+    if error:
+        return None, error
+
     return {
         'youtube_url': youtube_url,
         'video_file': video_file,
-        'reference_audio': reference_audio
+        'video_upload_id': video_upload_id,
+        'reference_audio': reference_audio,
+        'quality': quality
     }, None
 
 
+def validate_quality(quality):
+    """Check the encoder profile picked by a job's latency-or-quality flag"""
+    if quality is None:
+        return DEFAULT_QUALITY, None
+    if not isinstance(quality, str) or quality not in PROFILES:
+        return None, f'Quality must be one of {", ".join(PROFILES)}'
+    return quality, None
+
+
+def select_speakers(body, distances):
+    """Pick the speakers of a re-cut from a threshold or explicit labels"""
+    threshold = body.get('threshold')
+    include = body.get('include')
+    exclude = body.get('exclude') or []
+
+    if threshold is not None and include is not None:
+        return None, 'Please provide either a threshold or speakers to include, not both'
+    if threshold is not None and (
+            not isinstance(threshold, (int, float)) or not 0 <= threshold <= 2):
+        return None, 'Threshold must be a cosine distance between 0 and 2'
+    for labels in (include, exclude):
+        if labels is None:
+            continue
+        if not isinstance(labels, list) or not all(isinstance(label, str) for label in labels):
+            return None, 'Speaker labels must be a list of strings'
+        unknown = set(labels) - set(distances)
+        if unknown:
+            return None, f'Unknown speakers: {", ".join(sorted(map(str, unknown)))}'
+
+    if include is not None:
+        speakers = set(include)
+    else:
+        if threshold is None:
+            threshold = MATCH_THRESHOLD
+        speakers = {label for label, distance in distances.items()
+                    if distance <= threshold}
+    speakers -= set(exclude)
+
+    if not speakers:
+        return None, 'No speakers selected'
+    return speakers, None
+
+
+def matched_segments(turns, matching_speakers):
+    return [(turn_start, turn_end)
+            for turn_start, turn_end, speaker_label in turns
+            if speaker_label in matching_speakers]
+
+
 @app.route('/', methods=['GET'])
 def hello():
     return jsonify({"message": "Hello"})
@@ -283,287 +185,919 @@ def hello():
 
 @app.route('/ping', methods=['GET'])
 def ping():
-    return jsonify({"message": "Pong!"})
+    """Liveness check, also reporting whether the app is ready for jobs"""
+    ready, checks = check_readiness(app)
+    return jsonify({"message": "Pong!", "live": True, "ready": ready, "checks": checks})
 
 
-def preprocess_audio(input_path, output_path, max_duration=300):
-    """Preprocess audio to reduce size and duration"""
-    try:
-        # Load audio
-        audio = AudioSegment.from_file(input_path)
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness check for load balancers, 503 until dependencies are up"""
+    ready, checks = check_readiness(app)
+    return jsonify({"ready": ready, "checks": checks}), 200 if ready else 503
 
-        # Convert to mono
-        audio = audio.set_channels(1)
 
-        # Downsample to 16kHz
-        audio = audio.set_frame_rate(16000)
+@app.route('/scratch', methods=['GET'])
+def scratch_usage():
+    """Scratch space used by the jobs on this node and what is left"""
+    return jsonify(app.scratch.usage())
 
-        # Limit duration if needed (e.g., 5 minutes)
-        if len(audio) > max_duration * 1000:
-            audio = audio[:max_duration * 1000]
 
-        # Export
-        audio.export(output_path, format='wav')
-        return True
-    except Exception as e:
-        print(f"Error preprocessing audio: {e}")
-        return False
+@app.route('/render_cache', methods=['GET'])
+def render_cache():
+    """Segment cache hit rate and disk usage"""
+    return jsonify(cache_stats(app.redis_client, app.segment_cache))
 
 
 class VideoProcessor(Thread):
-    def __init__(self, app, task_id, youtube_url=None, video_file_path=None, reference_audio_path=None):
+    def __init__(self, app, task_id, youtube_url=None, video_file_path=None, reference_audio_path=None,
+                 fingerprint=None, batch=None, quality=DEFAULT_QUALITY, preview=True,
+                 scratch=None):
         super().__init__()
         self.app = app
         self.task_id = task_id
         self.youtube_url = youtube_url
         self.video_file_path = video_file_path
         self.reference_audio_path = reference_audio_path
+        self.fingerprint = fingerprint
+        self.batch = batch
+        self.profile = PROFILES[quality]
+        self.preview = preview
+        # Inputs saved by the request handler are already in the job's scratch
+        self.scratch = scratch or app.scratch.create(task_id)
+
+    def check_cancelled(self):
+        """Stop the job at the next checkpoint once a cancel was requested"""
+        if self.app.tasks.cancel_requested(self.task_id):
+            raise TaskCancelled()
 
     def update_progress(self, message, percentage):
-        self.app.redis_client.set(
-            f"task:{self.task_id}",
-            json.dumps({
-                'state': 'PROGRESS',
-                'message': message,
-                'percentage': percentage
-            })
+        # Progress is reported from inside long steps (ffmpeg, download,
+        # diarization, encoding), which makes it a natural cancel checkpoint
+        self.check_cancelled()
+        self.scratch.check_quota()
+        self.app.tasks.update(
+            self.task_id,
+            state='PROGRESS',
+            message=message,
+            percentage=percentage
         )
+        if self.batch:
+            self.batch.child_progress(self.task_id, percentage)
+
+    def progress_range(self, message, start, end):
+        """Return a callback reporting a step's progress between two percentages"""
+        return ProgressRange(self.update_progress, message, start, end)
 
     def run(self):
         try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Initialize paths
-                video_path = os.path.join(temp_dir, 'processed_video.mp4')
-                audio_path = os.path.join(temp_dir, 'audio.wav')
-                output_dir = os.path.join(temp_dir, 'extracted_speakers')
-                output_video = os.path.join(
-                    temp_dir, f'output_{uuid.uuid4()}.mp4')
-                os.makedirs(output_dir, exist_ok=True)
-
-                self.update_progress("Processing input files...", 10)
-
-                # Process video based on input type
-                if self.youtube_url:
-                    actual_output, error = download_youtube_video(
-                        self.youtube_url, video_path)
-                    if error:
-                        raise Exception(error)
-                    video_path = actual_output
-                else:
-                    # Copy uploaded video to processing directory
-                    shutil.copy2(self.video_file_path, video_path)
-
-                self.update_progress("Extracting audio...", 30)
-                # Extract audio with optimized settings
-                command = f"ffmpeg -i {video_path} -vn -acodec pcm_s16le -ar 16000 -ac 1 {audio_path} -y"
-                subprocess.call(command, shell=True)
+            result = self.process()
+            self.update_progress("Complete!", 100)
+            self.app.tasks.finish(self.task_id, result)
 
-                self.update_progress("Performing speaker diarization...", 50)
-                # Initialize and configure diarization pipeline
-                pipeline = Pipeline.from_pretrained(
-                    "pyannote/speaker-diarization",
-                    use_auth_token=HF_TOKEN
-                )
-                device = 'cpu'
-                if torch.cuda.is_available():
-                    device = "cuda"
-                    print(f"Using GPU: {torch.cuda.get_device_name()}")
-                pipeline.to(torch.device(device))
-                pipeline.instantiate({
-                    "segmentation": {
-                        "min_duration_off": 0.8,
-                        "threshold": 0.55
-                    },
-                    # "clustering": {
-                    #     "method": "fast",
-                    #     "min_cluster_size": 10
-                    # }
-                })
-
-                # Perform diarization
-                diarization_result = pipeline(audio_path)
-
-                self.update_progress("Extracting speaker segments...", 70)
-                # Extract speaker segments
-                extract_speaker_segments(
-                    audio_path, diarization_result, output_dir)
-
-                self.update_progress("Matching speakers...", 80)
-                # Match speakers
-                matching_speakers, distances = match_speakers(
-                    self.reference_audio_path, output_dir)
-
-                if not matching_speakers:
-                    raise Exception('No matching speakers found')
-
-                self.update_progress("Generating final video...", 90)
-                # Generate final video
-                video = VideoFileClip(video_path)
-                segments = []
-
-                for speech_turn, _, speaker_label in diarization_result.itertracks(yield_label=True):
-                    if speaker_label in matching_speakers:
-                        try:
-                            segment = video.subclip(
-                                speech_turn.start, speech_turn.end)
-                            segments.append(segment)
-                        except Exception as e:
-                            print(f"Error processing segment: {e}")
-                            continue
-
-                if not segments:
-                    video.close()
-                    raise Exception('No segments found for matching speakers')
-
-                final_video = concatenate_videoclips(segments)
-                final_video.write_videofile(
-                    output_video,
-                    codec='libx264',
-                    audio_codec='aac',
-                    preset='ultrafast',
-                    threads=4,
-                    temp_audiofile='temp-audio.m4a',
-                    remove_temp=True
-                )
+        except TaskCancelled:
+            print(f"Task {self.task_id} cancelled")
+            self.app.tasks.cancel(self.task_id)
+        except Exception as e:
+            print(f"Error in video processing: {e}")
+            self.app.tasks.fail(self.task_id, str(e))
+        finally:
+            self.cleanup()
+
+    def process(self):
+        # The ML and video stack is only loaded once a job actually runs
+        import processing
+
+        # Initialize paths, videos go to disk and audio to the fast volume
+        video_path = self.scratch.video_path('processed_video.mp4')
+        audio_path = self.scratch.fast_path('audio.wav')
+        output_dir = self.scratch.fast_path('extracted_speakers')
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.update_progress("Processing input files...", 10)
+
+        # Process video based on input type
+        if self.youtube_url:
+            actual_output, error = processing.download_youtube_video(
+                self.youtube_url, video_path,
+                on_progress=self.progress_range(
+                    "Downloading video...", 10, 15))
+            if error:
+                raise Exception(error)
+            video_path = actual_output
+        else:
+            # Uploads are processed where they were saved
+            video_path = self.video_file_path
+
+        self.update_progress("Extracting audio...", 15)
+        # Extract audio with optimized settings
+        returncode = run_ffmpeg(
+            ["-i", video_path, "-vn", "-acodec", "pcm_s16le",
+             "-ar", "16000", "-ac", "1", audio_path, "-y"],
+            duration=probe_duration(video_path),
+            on_progress=self.progress_range(
+                "Extracting audio...", 15, 30)
+        )
+        if returncode != 0:
+            raise Exception('Failed to extract audio from video')
+
+        self.update_progress("Performing speaker diarization...", 30)
+        diarization_result = processing.diarize(
+            audio_path,
+            hook=DiarizationProgressHook(self.progress_range(
+                "Performing speaker diarization...", 30, 70))
+        )
+        turns = processing.speaker_turns(diarization_result)
+
+        self.update_progress("Extracting speaker segments...", 70)
+        # Extract speaker segments
+        processing.extract_speaker_segments(
+            audio_path, diarization_result, output_dir)
+
+        self.update_progress("Matching speakers...", 80)
+        # Match speakers, batch jobs share one embedding of the reference
+        embeddings = processing.speaker_embeddings(output_dir)
+        matching_speakers, distances = processing.match_speakers(
+            self.reference_audio_path, output_dir,
+            reference_embedding=self.batch.reference_embedding() if self.batch else None,
+            embeddings=embeddings)
+
+        # Keep what a re-cut needs (the source video, the speaker turns and
+        # distances), even when nobody matched at the current threshold
+        video_path = keep_source(self.task_id, video_path)
+        self.app.tasks.save_analysis(self.task_id, turns, distances, self.task_id)
+        self.index_speakers(video_path, turns, embeddings)
+
+        if not matching_speakers:
+            raise Exception('No matching speakers found')
+
+        return self.render_and_upload(
+            video_path, turns, matching_speakers, distances, start=85)
+
+    def index_speakers(self, video_path, turns, embeddings):
+        """Add every speaker of the video to the cross-video speaker index"""
+        from speaker_index import get_speaker_index
+
+        source = self.youtube_url or os.path.basename(self.video_file_path)
+        try:
+            get_speaker_index().add_video(
+                source_fingerprint(video_path), self.task_id, source, turns, embeddings)
+        except Exception as e:
+            # The index is a side product, it never fails the job
+            print(f"Error indexing speakers: {e}")
 
-                # Clean up video objects
-                for segment in segments:
-                    segment.close()
-                video.close()
-                final_video.close()
-
-                # Upload to S3
-                self.update_progress("Uploading video...", 95)
-                s3_url = upload_to_s3(
-                    output_video,
-                    S3_BUCKET_NAME,
-                    f'processed_videos/{os.path.basename(output_video)}'
-                )
+    def render_preview(self, video_path, segments, start, end):
+        """Render and upload a low resolution preview of the matched turns
 
-                if not s3_url:
-                    raise Exception('Failed to upload to S3')
-
-                # Final result
-                result = {
-                    'status': 'success',
-                    'video_url': s3_url,
-                    'matching_speakers': list(matching_speakers),
-                    'speaker_distances': distances
-                }
-
-                self.update_progress("Complete!", 100)
-                self.app.redis_client.set(
-                    f"task:{self.task_id}",
-                    json.dumps({'state': 'SUCCESS', 'result': result})
-                )
+        The preview is published as soon as it's uploaded, so a wrong match
+        can be rejected (see /reject) before the full render is done.
+        """
+        import processing
 
-        except Exception as e:
-            print(f"Error in video processing: {e}")
-            self.app.redis_client.set(
-                f"task:{self.task_id}",
-                json.dumps({'state': 'FAILURE', 'error': str(e)})
+        preview_video = self.scratch.video_path(f'preview_{uuid.uuid4()}.mp4')
+        self.update_progress("Rendering preview...", start)
+        try:
+            render_segments(
+                video_path,
+                segments,
+                preview_video,
+                self.scratch.fast_dir,
+                cache=self.app.segment_cache,
+                profile=PREVIEW_PROFILE,
+                on_progress=self.progress_range("Rendering preview...", start, end)
             )
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            # The full render goes on without a preview
+            print(f"Error rendering preview: {e}")
+            return
+
+        preview_url = processing.upload_to_s3(
+            preview_video,
+            S3_BUCKET_NAME,
+            f'previews/{os.path.basename(preview_video)}'
+        )
+        os.remove(preview_video)
+        if preview_url:
+            self.app.tasks.update(self.task_id, event_type='preview',
+                                  preview_url=preview_url)
+
+    def render_and_upload(self, video_path, turns, matching_speakers, distances, start):
+        """Render the turns of the matching speakers and upload the video"""
+        import processing
+
+        output_video = self.scratch.video_path(f'output_{uuid.uuid4()}.mp4')
+        segments = matched_segments(turns, matching_speakers)
+
+        if self.preview:
+            self.render_preview(video_path, segments, start, start + 3)
+            start += 3
+
+        self.update_progress("Generating final video...", start)
+        # Generate final video
+        cache_usage = render_segments(
+            video_path,
+            segments,
+            output_video,
+            self.scratch.fast_dir,
+            cache=self.app.segment_cache,
+            profile=self.profile,
+            on_progress=self.progress_range(
+                "Generating final video...", start, 95)
+        )
+        record_cache_stats(self.app.redis_client, cache_usage)
+
+        # Upload to S3
+        self.update_progress("Uploading video...", 95)
+        s3_url = processing.upload_to_s3(
+            output_video,
+            S3_BUCKET_NAME,
+            f'processed_videos/{os.path.basename(output_video)}'
+        )
+
+        if not s3_url:
+            raise Exception('Failed to upload to S3')
+
+        if self.batch:
+            self.batch.keep_output(self.task_id, output_video)
+
+        # Final result
+        return {
+            'status': 'success',
+            'video_url': s3_url,
+            'matching_speakers': sorted(matching_speakers),
+            'speaker_distances': distances,
+            'quality': self.profile.name,
+            'render_cache': cache_usage
+        }
+
+    def discard(self):
+        """Cancel the job before it started running"""
+        self.app.tasks.cancel(self.task_id)
+        self.cleanup()
+
+    def cleanup(self):
+        if self.fingerprint:
+            self.app.tasks.release_inflight(self.fingerprint, self.task_id)
+
+        # Batch inputs live in the batch's scratch, everything else in ours
+        if self.video_file_path and os.path.exists(self.video_file_path):
+            try:
+                os.remove(self.video_file_path)
+            except Exception as e:
+                print(f"Error cleaning up video file: {e}")
+        self.scratch.cleanup()
+
+        if self.batch:
+            self.batch.child_done(self.task_id)
+
+
+class RecutProcessor(VideoProcessor):
+    """Re-render a finished task with a different speaker selection"""
+
+    def __init__(self, app, task_id, source_task_id, turns, matching_speakers, distances,
+                 fingerprint=None, quality=DEFAULT_QUALITY):
+        # The speakers were already picked, a preview would only slow it down
+        super().__init__(app, task_id, fingerprint=fingerprint, quality=quality,
+                         preview=False)
+        self.source_task_id = source_task_id
+        self.turns = turns
+        self.matching_speakers = matching_speakers
+        self.distances = distances
+
+    def process(self):
+        video_path = source_path(self.source_task_id)
+        if not os.path.exists(video_path):
+            raise Exception('Source video is no longer available')
+        # Using the source keeps it around for another ARTIFACT_TTL
+        os.utime(os.path.dirname(video_path))
+
+        self.app.tasks.save_analysis(
+            self.task_id, self.turns, self.distances, self.source_task_id)
+        result = self.render_and_upload(
+            video_path, self.turns, self.matching_speakers, self.distances,
+            start=10)
+        result['source_task_id'] = self.source_task_id
+        return result
+
+
+class SpeakerSearchProcessor(VideoProcessor):
+    """Embed a reference voice on the worker pool and search the speaker index"""
+
+    def __init__(self, app, task_id, reference_audio_path, scratch, threshold, limit):
+        super().__init__(app, task_id, reference_audio_path=reference_audio_path,
+                         preview=False, scratch=scratch)
+        self.threshold = threshold
+        self.limit = limit
+
+    def process(self):
+        import processing
+        from speaker_index import get_speaker_index
+
+        self.update_progress("Embedding reference voice...", 10)
+        embedding = processing.embed_reference(self.reference_audio_path)
+
+        self.update_progress("Searching indexed videos...", 90)
+        start = time.time()
+        results, searched = get_speaker_index().search(
+            embedding, threshold=self.threshold, limit=self.limit)
+        return {
+            'status': 'success',
+            'results': results,
+            'searched_speakers': searched,
+            'search_ms': round((time.time() - start) * 1000, 2)
+        }
+
+
+class BatchProcessor(Thread):
+    """Match one reference against many videos, a few of them at a time
+
+    Every video runs as its own task through the scheduler, at most
+    BATCH_CONCURRENCY of them queued or running at once. The batch task
+    reports the progress of all videos and collects their results.
+    """
+
+    def __init__(self, app, batch_id, sources, reference_audio_path, scratch,
+                 supercut=False, quality=DEFAULT_QUALITY):
+        super().__init__()
+        # Make thread daemon so it exits when main thread exits
+        self.daemon = True
+        self.app = app
+        self.batch_id = batch_id
+        self.sources = sources
+        self.reference_audio_path = reference_audio_path
+        self.scratch = scratch
+        self.supercut = supercut
+        self.quality = quality
+        self.condition = Condition()
+        self.changed = False
+        self.children = {}  # task id -> source
+        self.pending = []
+        self.running = set()
+        self.progress = {}
+        self.outputs = {}
+        self.embedding = None
+        self.embedding_lock = Lock()
+
+    def reference_embedding(self):
+        with self.embedding_lock:
+            if self.embedding is None:
+                import processing
+                self.embedding = processing.embed_reference(
+                    self.reference_audio_path)
+            return self.embedding
+
+    def child_progress(self, task_id, percentage):
+        with self.condition:
+            self.progress[task_id] = percentage
+            self.changed = True
+            self.condition.notify_all()
+
+    def child_done(self, task_id):
+        with self.condition:
+            self.running.discard(task_id)
+            self.progress[task_id] = 100
+            self.changed = True
+            self.condition.notify_all()
+
+    def keep_output(self, task_id, video_path):
+        """Hold on to a rendered video until the supercut is stitched"""
+        if not self.supercut:
+            return
+        output_path = handoff(video_path, self.scratch.video_path(f'output_{task_id}.mp4'))
+        with self.condition:
+            self.outputs[task_id] = output_path
+
+    def run(self):
+        try:
+            self.create_children()
+            self.run_children()
+            self.app.tasks.finish(self.batch_id, self.collect_results())
+        except TaskCancelled:
+            print(f"Batch {self.batch_id} cancelled")
+            self.cancel_children()
+            self.app.tasks.cancel(self.batch_id)
+        except Exception as e:
+            print(f"Error in batch processing: {e}")
+            self.cancel_children()
+            self.app.tasks.fail(self.batch_id, str(e))
         finally:
-            # Clean up temporary files
-            if self.video_file_path and os.path.exists(self.video_file_path):
-                try:
-                    os.remove(self.video_file_path)
-                except Exception as e:
-                    print(f"Error cleaning up video file: {e}")
+            self.scratch.cleanup()
+
+    def check_cancelled(self):
+        if self.app.tasks.cancel_requested(self.batch_id):
+            raise TaskCancelled()
+
+    def create_children(self):
+        self.app.tasks.update(self.batch_id, state='PROGRESS',
+                              message="Listing videos...", percentage=0)
+        sources = []
+        for source in self.sources:
+            if 'playlist_url' in source:
+                room = MAX_BATCH_VIDEOS - len(sources)
+                if room <= 0:
+                    # A limit of 0 would list the whole playlist
+                    continue
+                import processing
+                urls = processing.expand_playlist(source['playlist_url'], room)
+                sources.extend({'youtube_url': url} for url in urls)
+            else:
+                sources.append(source)
+        sources = sources[:MAX_BATCH_VIDEOS]
+        if not sources:
+            raise Exception('No videos found')
 
-            if self.reference_audio_path and os.path.exists(self.reference_audio_path):
-                try:
-                    os.remove(self.reference_audio_path)
-                except Exception as e:
-                    print(f"Error cleaning up audio file: {e}")
+        for source in sources:
+            task_id = str(uuid.uuid4())
+            self.app.tasks.create(task_id, batch_id=self.batch_id)
+            self.children[task_id] = source
+            self.pending.append(task_id)
+        self.app.tasks.update(self.batch_id, task_ids=list(self.children),
+                              videos_total=len(self.children))
+
+    def submit_child(self, task_id):
+        source = self.children[task_id]
+        estimate = estimate_job(
+            youtube_url=source.get('youtube_url'),
+            video_file_path=source.get('video_file_path'),
+            encode_factor=PROFILES[self.quality].cpu_factor
+        )
+        task = VideoProcessor(
+            self.app,
+            task_id,
+            youtube_url=source.get('youtube_url'),
+            video_file_path=source.get('video_file_path'),
+            batch=self,
+            quality=self.quality,
+            preview=False
+        )
+        task.scratch.reserve(estimate)
+        self.app.scheduler.submit(task, estimate)
+
+    def run_children(self):
+        while True:
+            with self.condition:
+                if not self.pending and not self.running:
+                    break
+                to_submit = []
+                while self.pending and len(self.running) < BATCH_CONCURRENCY:
+                    task_id = self.pending.pop(0)
+                    self.running.add(task_id)
+                    to_submit.append(task_id)
+
+            # Probing and queueing happen outside the lock, children keep reporting
+            for task_id in to_submit:
+                self.submit_child(task_id)
+            self.check_cancelled()
+            self.report_progress()
+
+            with self.condition:
+                if not self.changed:
+                    self.condition.wait(timeout=5)
+                self.changed = False
+        self.report_progress()
+
+    def report_progress(self):
+        with self.condition:
+            total = len(self.children)
+            done = total - len(self.pending) - len(self.running)
+            percentage = sum(self.progress.values()) / total
+        # The last few percent are left for the supercut
+        end = 95 if self.supercut else 99
+        self.app.tasks.update(
+            self.batch_id,
+            state='PROGRESS',
+            message=f"Processed {done} of {total} videos",
+            percentage=int(percentage * end / 100),
+            videos_done=done
+        )
+
+    def cancel_children(self):
+        with self.condition:
+            pending = list(self.pending)
+            self.pending.clear()
+            running = list(self.running)
+        for task_id in pending:
+            self.app.tasks.cancel(task_id)
+            path = self.children[task_id].get('video_file_path')
+            if path and os.path.exists(path):
+                os.remove(path)
+        for task_id in running:
+            self.app.tasks.request_cancel(task_id)
+            self.app.scheduler.cancel(task_id)
+
+        # Running videos still read from the batch's scratch, let them stop first
+        with self.condition:
+            while self.running:
+                self.condition.wait(timeout=5)
+
+    def collect_results(self):
+        statuses = self.app.tasks.get_many(list(self.children))
+        videos = []
+        for task_id, source in self.children.items():
+            status = statuses[task_id] or {'state': 'PENDING'}
+            video = {
+                'task_id': task_id,
+                'source': source.get('youtube_url') or source.get('filename'),
+                'state': status['state'],
+            }
+            if status['state'] == 'SUCCESS':
+                video['video_url'] = status['result']['video_url']
+                video['matching_speakers'] = status['result']['matching_speakers']
+            elif 'error' in status:
+                video['error'] = status['error']
+            videos.append(video)
+
+        failed = sum(1 for video in videos if video['state'] != 'SUCCESS')
+        self.app.tasks.update(self.batch_id, videos_failed=failed)
+        if failed == len(videos):
+            raise Exception('No video of the batch could be processed')
+
+        result = {'status': 'success', 'videos': videos}
+        if self.supercut:
+            result['supercut_url'] = self.stitch_supercut()
+        return result
+
+    def stitch_supercut(self):
+        import processing
+
+        self.check_cancelled()
+        self.app.tasks.update(self.batch_id, state='PROGRESS',
+                              message="Stitching supercut...", percentage=95)
+        video_paths = [self.outputs[task_id] for task_id in self.children
+                       if task_id in self.outputs]
+        output_video = self.scratch.video_path(f'supercut_{self.batch_id}.mp4')
+        stitch_videos(video_paths, output_video, self.scratch.fast_dir,
+                      profile=PROFILES[self.quality])
+
+        s3_url = processing.upload_to_s3(
+            output_video,
+            S3_BUCKET_NAME,
+            f'processed_videos/{os.path.basename(output_video)}'
+        )
+        if not s3_url:
+            raise Exception('Failed to upload the supercut to S3')
+        return s3_url
 
 
 @app.route('/process_video', methods=['POST'])
 def process_video():
     try:
+        if not app.scratch.has_room(request.content_length or 0):
+            return jsonify({'error': 'Not enough scratch space, try again later'}), 507
+
         # Validate inputs
         inputs, error = validate_inputs(request)
         if error:
             return jsonify({'error': error}), 400
 
-        # Create temporary directory for file storage
-        temp_dir = tempfile.mkdtemp()
+        # Generate task ID
+        task_id = str(uuid.uuid4())
+
+        # Inputs go straight into the job's scratch, the job reads them there
+        scratch = app.scratch.create(task_id)
 
         try:
-            # Save files to temporary directory
             video_file_path = None
             if inputs['video_file']:
-                video_file_path = os.path.join(
-                    temp_dir, secure_filename(inputs['video_file'].filename))
+                video_file_path = scratch.video_path(
+                    secure_filename(inputs['video_file'].filename))
                 inputs['video_file'].save(video_file_path)
+            elif inputs['video_upload_id']:
+                try:
+                    video_file_path = claim_upload(
+                        app.redis_client, inputs['video_upload_id'], scratch.video_dir)
+                except ValueError as e:
+                    scratch.cleanup()
+                    return jsonify({'error': str(e)}), 400
+
+            # Estimate the job's cost before anything is registered for it,
+            # and before anything is written to the fast volume
+            estimate = estimate_job(
+                youtube_url=inputs.get('youtube_url'),
+                video_file_path=video_file_path,
+                encode_factor=PROFILES[inputs['quality']].cpu_factor
+            )
+            scratch.reserve(estimate)
 
-            reference_audio_path = os.path.join(
-                temp_dir, secure_filename(inputs['reference_audio'].filename))
+            reference_audio_path = scratch.fast_path(
+                secure_filename(inputs['reference_audio'].filename))
             inputs['reference_audio'].save(reference_audio_path)
 
-            # Generate task ID
-            task_id = str(uuid.uuid4())
-
-            # Create and queue the task
-            task = VideoProcessor(
-                app,  # Pass the app instance
-                task_id,
+            # Attach identical submissions to the task already in flight
+            fingerprint = job_fingerprint(
                 youtube_url=inputs.get('youtube_url'),
                 video_file_path=video_file_path,
-                reference_audio_path=reference_audio_path
+                reference_audio_path=reference_audio_path,
+                params={'quality': inputs['quality']}
             )
+            app.tasks.create(task_id, fingerprint=fingerprint, attachments=1)
+            existing_task_id = app.tasks.claim_inflight(fingerprint, task_id)
+            if existing_task_id:
+                app.tasks.delete(task_id)
+                scratch.cleanup()
+                return jsonify({'task_id': existing_task_id, 'deduplicated': True}), 202
+
+            try:
+                # Create and queue the task
+                task = VideoProcessor(
+                    app,  # Pass the app instance
+                    task_id,
+                    youtube_url=inputs.get('youtube_url'),
+                    video_file_path=video_file_path,
+                    reference_audio_path=reference_audio_path,
+                    fingerprint=fingerprint,
+                    quality=inputs['quality'],
+                    scratch=scratch
+                )
+
+                app.scheduler.submit(task, estimate)
+            except Exception as e:
+                app.tasks.abandon(task_id, fingerprint, str(e))
+                raise e
+
+            return jsonify({'task_id': task_id}), 202
+
+        except Exception as e:
+            scratch.cleanup()
+            raise e
+
+    except Exception as e:
+        print(f"Error in process_video: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/process_batch', methods=['POST'])
+def process_batch():
+    """Process many videos (URLs, a playlist or uploads) against one reference"""
+    try:
+        if not app.scratch.has_room(request.content_length or 0):
+            return jsonify({'error': 'Not enough scratch space, try again later'}), 507
+
+        reference_audio = request.files.get('reference_audio')
+        if not reference_audio:
+            return jsonify({'error': 'No reference audio file'}), 400
+        if not allowed_audio_file(reference_audio.filename):
+            return jsonify({'error': 'Invalid audio file format'}), 400
+
+        youtube_urls = [url.strip() for url in request.form.getlist('youtube_url')
+                        if url.strip()]
+        playlist_url = request.form.get('playlist_url')
+        upload_ids = request.form.getlist('video_upload_id')
+        if not youtube_urls and not playlist_url and not upload_ids:
+            return jsonify({'error': 'Please provide YouTube URLs, a playlist or uploaded videos'}), 400
+        if len(youtube_urls) + len(upload_ids) > MAX_BATCH_VIDEOS:
+            return jsonify({'error': f'A batch holds at most {MAX_BATCH_VIDEOS} videos'}), 400
+        supercut = request.form.get('supercut', '').lower() in ('1', 'true')
+        quality, error = validate_quality(request.form.get('quality'))
+        if error:
+            return jsonify({'error': error}), 400
+
+        # Removed by the batch once every video is done
+        batch_id = str(uuid.uuid4())
+        scratch = app.scratch.create(batch_id)
+        try:
+            sources = [{'youtube_url': url} for url in youtube_urls]
+            for index, upload_id in enumerate(upload_ids):
+                # Uploads may share a filename, give each its own directory
+                upload_dir = scratch.video_path(f'upload_{index}')
+                os.makedirs(upload_dir, exist_ok=True)
+                try:
+                    video_file_path = claim_upload(
+                        app.redis_client, upload_id, upload_dir)
+                except ValueError as e:
+                    scratch.cleanup()
+                    return jsonify({'error': str(e)}), 400
+                sources.append({'video_file_path': video_file_path,
+                                'filename': os.path.basename(video_file_path)})
+            if playlist_url:
+                sources.append({'playlist_url': playlist_url})
+
+            reference_audio_path = scratch.fast_path(
+                secure_filename(reference_audio.filename))
+            reference_audio.save(reference_audio_path)
+
+            app.tasks.create(batch_id, kind='batch')
+            BatchProcessor(app, batch_id, sources, reference_audio_path,
+                           scratch, supercut=supercut, quality=quality).start()
+
+            return jsonify({'task_id': batch_id}), 202
+
+        except Exception as e:
+            scratch.cleanup()
+            raise e
+
+    except Exception as e:
+        print(f"Error in process_batch: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/recut/<task_id>', methods=['POST'])
+def recut_video(task_id):
+    """Re-render a processed video with a new threshold or speaker selection"""
+    try:
+        analysis = app.tasks.get_analysis(task_id)
+        if analysis is None:
+            return jsonify({'error': 'Unknown task, or its analysis has expired'}), 404
+
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            body = {}
+        matching_speakers, error = select_speakers(
+            body, analysis['speaker_distances'])
+        if error:
+            return jsonify({'error': error}), 400
+        quality, error = validate_quality(body.get('quality'))
+        if error:
+            return jsonify({'error': error}), 400
 
-            # Initialize task status in Redis
-            app.redis_client.set(
-                f"task:{task_id}",
-                json.dumps({'state': 'PENDING'})
+        source_task_id = analysis['source_task_id']
+        if not os.path.exists(source_path(source_task_id)):
+            return jsonify({'error': 'The source video has expired'}), 410
+
+        turns = [tuple(turn) for turn in analysis['turns']]
+        duration = sum(end - start for start, end, speaker_label in turns
+                       if speaker_label in matching_speakers)
+        estimate = estimate_render(source_path(source_task_id), duration,
+                                   encode_factor=PROFILES[quality].cpu_factor)
+
+        recut_task_id = str(uuid.uuid4())
+        fingerprint = params_fingerprint(
+            source=source_task_id, speakers=sorted(matching_speakers), quality=quality)
+        app.tasks.create(recut_task_id, fingerprint=fingerprint,
+                         parent_task_id=task_id, attachments=1)
+        existing_task_id = app.tasks.claim_inflight(fingerprint, recut_task_id)
+        if existing_task_id:
+            app.tasks.delete(recut_task_id)
+            return jsonify({'task_id': existing_task_id, 'deduplicated': True}), 202
+
+        task = None
+        try:
+            task = RecutProcessor(
+                app,
+                recut_task_id,
+                source_task_id,
+                turns,
+                matching_speakers,
+                analysis['speaker_distances'],
+                fingerprint=fingerprint,
+                quality=quality
             )
+            task.scratch.reserve(estimate)
+            app.scheduler.submit(task, estimate)
+        except Exception as e:
+            app.tasks.abandon(recut_task_id, fingerprint, str(e))
+            if task:
+                task.scratch.cleanup()
+            raise e
 
-            # Add task to queue
-            app.task_queue.put(task)
+        return jsonify({
+            'task_id': recut_task_id,
+            'matching_speakers': sorted(matching_speakers)
+        }), 202
+
+    except Exception as e:
+        print(f"Error in recut_video: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/speaker_search', methods=['POST'])
+def speaker_search():
+    """Find the indexed videos, and the time ranges, where a voice speaks
+
+    The reference is embedded on the worker pool like any other job, the
+    results are the task's result.
+    """
+    try:
+        reference_audio = request.files.get('reference_audio')
+        if not reference_audio:
+            return jsonify({'error': 'No reference audio file'}), 400
+        if not allowed_audio_file(reference_audio.filename):
+            return jsonify({'error': 'Invalid audio file format'}), 400
+        try:
+            threshold = float(request.form.get('threshold', MATCH_THRESHOLD))
+            limit = int(request.form.get('limit', 20))
+        except ValueError:
+            return jsonify({'error': 'Threshold and limit must be numbers'}), 400
+
+        task_id = str(uuid.uuid4())
+        scratch = app.scratch.create(task_id)
+        try:
+            # The reference is the job's only file, it's read straight from disk
+            reference_audio_path = scratch.video_path(
+                secure_filename(reference_audio.filename))
+            reference_audio.save(reference_audio_path)
+            estimate = estimate_embedding(reference_audio_path)
+            scratch.reserve(estimate)
+
+            app.tasks.create(task_id, kind='speaker_search')
+            task = SpeakerSearchProcessor(app, task_id, reference_audio_path, scratch,
+                                          threshold=threshold, limit=limit)
+            app.scheduler.submit(task, estimate)
 
             return jsonify({'task_id': task_id}), 202
 
         except Exception as e:
-            # Clean up temp directory if there's an error
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            scratch.cleanup()
             raise e
 
     except Exception as e:
-        print(f"Error in process_video: {e}")
+        print(f"Error in speaker_search: {e}")
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/task_status/<task_id>', methods=['GET'])
-def task_status(task_id):
+@app.route('/cancel/<task_id>', methods=['POST'])
+def cancel_task(task_id):
+    """Cancel a queued or running task
+
+    Deduplicated submissions share a task, so this only detaches the caller
+    while other clients are still attached to it.
+    """
     try:
-        status = app.redis_client.get(f"task:{task_id}")
+        status = app.tasks.get(task_id)
         if status is None:
-            return jsonify({'state': 'PENDING'})
+            return jsonify({'error': 'Unknown task'}), 404
+        if status['state'] in TERMINAL_STATES:
+            return jsonify({'task_id': task_id, 'state': status['state']}), 409
+
+        # Once nobody is left, running jobs (in any worker process) stop at
+        # their next checkpoint
+        attachments = app.tasks.detach(task_id)
+        if attachments > 0:
+            return jsonify({'task_id': task_id, 'state': status['state'],
+                            'detached': True, 'attachments': attachments})
+        if app.scheduler.cancel(task_id):
+            return jsonify({'task_id': task_id, 'state': 'CANCELLED'})
+        return jsonify({'task_id': task_id, 'state': 'CANCELLING'}), 202
+    except Exception as e:
+        print(f"Error cancelling task: {e}")
+        return jsonify({'error': str(e)}), 500
+
 
-        return jsonify(json.loads(status))
+@app.route('/reject/<task_id>', methods=['POST'])
+def reject_task(task_id):
+    """Stop the full render of a task whose preview shows the wrong speaker
+
+    The task's speaker turns and distances are kept, so it can still be
+    re-cut with another threshold or speaker selection. Like a cancel, this
+    only detaches the caller while other clients are attached to the task.
+    """
+    try:
+        status = app.tasks.get(task_id)
+        if status is None:
+            return jsonify({'error': 'Unknown task'}), 404
+        if status['state'] in TERMINAL_STATES:
+            return jsonify({'task_id': task_id, 'state': status['state']}), 409
+        if 'preview_url' not in status:
+            return jsonify({'error': 'The task has no preview yet'}), 409
+
+        attachments = app.tasks.reject(task_id)
+        if attachments > 0:
+            return jsonify({'task_id': task_id, 'state': status['state'],
+                            'detached': True, 'attachments': attachments})
+        return jsonify({'task_id': task_id, 'state': 'CANCELLING'}), 202
+    except Exception as e:
+        print(f"Error rejecting task: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/task_status/<task_id>', methods=['GET'])
+def task_status(task_id):
+    try:
+        return jsonify(task_status_response(app.tasks.get(task_id)))
     except Exception as e:
         print(f"Error getting task status: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/task_status', methods=['POST'])
+def batch_task_status():
+    """Return the status of several tasks in a single request"""
+    try:
+        task_ids, error = parse_batch_status_request(request.get_json(silent=True))
+        if error:
+            return jsonify({'error': error}), 400
+
+        return jsonify(batch_status_response(app.tasks.get_many(task_ids)))
+    except Exception as e:
+        print(f"Error getting task statuses: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 # Update the cleanup function
 
 
 @atexit.register
 def cleanup():
     try:
-        # Stop task processor
-        app.task_queue.put(None)  # Signal the task processor to stop
-        # Wait for task processor to finish with timeout
-        app.task_processor.join(timeout=1)
+        # Stop the scheduler's workers, waiting briefly for them to exit
+        if app.scheduler:
+            app.scheduler.stop(timeout=1)
 
         # Close Redis client connection
         app.redis_client.close()
 
-        # Stop Redis server
-        stop_redis_server()
-
     except Exception as e:
         print(f"Error during cleanup: {e}")
 
@@ -586,6 +1120,8 @@ def calculate_progress(current_step, total_steps):
 @app.route('/stream_video', methods=['POST'])
 def stream_video():
     try:
+        import processing
+
         progress_id = str(uuid.uuid4())
         total_steps = 6  # Total number of processing steps
         current_step = 0
@@ -601,6 +1137,8 @@ def stream_video():
         inputs, error = validate_inputs(request)
         if error:
             return jsonify({'error': error}), 400
+        if inputs['video_upload_id']:
+            return jsonify({'error': 'Upload sessions are only supported by /process_video'}), 400
 
         current_step += 1
         send_progress("Processing input files...",
@@ -624,7 +1162,7 @@ def stream_video():
                           calculate_progress(current_step, total_steps))
 
             if inputs['youtube_url']:
-                video_path = download_youtube_video(
+                video_path = processing.download_youtube_video(
                     inputs['youtube_url'], video_path)
                 if not video_path:
                     return jsonify({'error': 'Failed to download YouTube video'}), 500
@@ -641,23 +1179,21 @@ def stream_video():
             current_step += 1
             send_progress("Extracting audio...",
                           calculate_progress(current_step, total_steps))
-            audio_path = extract_audio_from_video(video_path, audio_path)
+            audio_path = processing.extract_audio_from_video(video_path, audio_path)
 
             # Perform diarization
             current_step += 1
             send_progress("Performing speaker diarization...",
                           calculate_progress(current_step, total_steps))
-            pipeline = Pipeline.from_pretrained(
-                "pyannote/speaker-diarization", use_auth_token=HF_TOKEN)
-            diarization_result = pipeline(audio_path)
+            diarization_result = processing.diarize(audio_path)
 
             # Match speakers
             current_step += 1
             send_progress("Matching speakers...",
                           calculate_progress(current_step, total_steps))
-            extract_speaker_segments(
+            processing.extract_speaker_segments(
                 audio_path, diarization_result, output_dir)
-            matching_speakers, distances = match_speakers(
+            matching_speakers, distances = processing.match_speakers(
                 reference_path, output_dir)
 
             if not matching_speakers:
@@ -667,7 +1203,7 @@ def stream_video():
             current_step += 1
             send_progress("Generating final video...",
                           calculate_progress(current_step, total_steps))
-            final_video_path = extract_matching_speaker_segments(
+            final_video_path = processing.extract_matching_speaker_segments(
                 video_path,
                 diarization_result,
                 matching_speakers,
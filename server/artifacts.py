@@ -0,0 +1,75 @@
+"""
+Per-task artifacts kept after a job finishes.
+
+The source video of a finished task is kept under ARTIFACT_DIR/<task_id>
+so it can be re-cut without downloading and diarizing it again. Artifacts
+that haven't been used for ARTIFACT_TTL seconds are removed, and the store
+is capped at ARTIFACT_MAX_BYTES by removing the least recently used ones.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from scratch import dir_size
+from tasks import TASK_SUCCESS_TTL
+
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", os.path.join(
+    tempfile.gettempdir(), 'snipclips-artifacts'))
+ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", TASK_SUCCESS_TTL))
+ARTIFACT_MAX_BYTES = int(os.getenv(
+    "ARTIFACT_MAX_BYTES", 20 * 1024 * 1024 * 1024))  # 20GB
+
+
+def source_path(task_id):
+    return os.path.join(ARTIFACT_DIR, task_id, 'source.mp4')
+
+
+def keep_source(task_id, video_path):
+    """Move a task's source video into the artifact store, return its new path"""
+    prune_artifacts()
+    dest_path = source_path(task_id)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    shutil.move(video_path, dest_path)
+    evict_artifacts(keep={os.path.dirname(dest_path)})
+    return dest_path
+
+
+def prune_artifacts():
+    """Remove the artifacts of tasks not used for ARTIFACT_TTL seconds"""
+    if not os.path.isdir(ARTIFACT_DIR):
+        return
+    cutoff = time.time() - ARTIFACT_TTL
+    with os.scandir(ARTIFACT_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
+
+
+def artifact_entries():
+    entries = []
+    with os.scandir(ARTIFACT_DIR) as scan:
+        for entry in scan:
+            try:
+                if entry.is_dir():
+                    entries.append((entry.stat().st_mtime, entry.path, dir_size(entry.path)))
+            except FileNotFoundError:
+                continue
+    return entries
+
+
+def evict_artifacts(keep=()):
+    """Remove the least recently used artifacts until under the size cap"""
+    entries = sorted(artifact_entries())
+    total = sum(size for _, _, size in entries)
+    for _, path, size in entries:
+        if total <= ARTIFACT_MAX_BYTES:
+            break
+        if path in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
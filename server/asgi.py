@@ -0,0 +1,349 @@
+"""
+ASGI entry point.
+
+The I/O bound endpoints (task status, event streams, result delivery and
+upload sessions) are served natively on the event loop with an async Redis
+client, so idle connections don't hold a worker. All event streams of a
+process share a single Redis subscription. Everything else is handed
+to the Flask app, which keeps feeding CPU bound jobs to its worker pool.
+
+Run with: uvicorn --app-dir server asgi:app
+"""
+
+import asyncio
+import json
+import os
+import uuid
+from contextlib import asynccontextmanager, suppress
+
+import anyio
+import redis.asyncio as aioredis
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.utils import secure_filename
+
+from app import app as flask_app, allowed_video_file
+from config import REDIS_URL, MAX_CONTENT_LENGTH
+from tasks import (AsyncTaskStore, task_status_response, parse_batch_status_request,
+                   batch_status_response)
+from uploads import UPLOAD_DIR, UPLOAD_TTL, upload_key, upload_path, stale_uploads
+
+HEARTBEAT_INTERVAL = 15  # seconds between keep-alive comments
+TERMINAL_STATE_EVENTS = {'SUCCESS': 'success', 'FAILURE': 'failure', 'CANCELLED': 'cancelled'}
+TERMINAL_EVENTS = set(TERMINAL_STATE_EVENTS.values())
+
+
+def format_event(message):
+    """Serialize a flask_sse message dict into the server-sent events format"""
+    data = message['data']
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    lines = [f"data:{line}" for line in data.splitlines()]
+    if message.get('type'):
+        lines.insert(0, f"event:{message['type']}")
+    if message.get('id'):
+        lines.append(f"id:{message['id']}")
+    if message.get('retry'):
+        lines.append(f"retry:{message['retry']}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def task_status(request):
+    task_id = request.path_params['task_id']
+    status = await request.app.state.tasks.get(task_id)
+    return JSONResponse(task_status_response(status))
+
+
+async def batch_task_status(request):
+    """Return the status of several tasks in a single round-trip"""
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    task_ids, error = parse_batch_status_request(body)
+    if error:
+        return JSONResponse({'error': error}, status_code=400)
+
+    statuses = await request.app.state.tasks.get_many(task_ids)
+    return JSONResponse(batch_status_response(statuses))
+
+
+async def task_result(request):
+    """Redirect to the rendered video (or a batch's supercut) of a finished task"""
+    task_id = request.path_params['task_id']
+    status = await request.app.state.tasks.get(task_id)
+    if status is None:
+        return JSONResponse({'error': 'Unknown task'}, status_code=404)
+    if status['state'] != 'SUCCESS':
+        return JSONResponse({'state': status['state']}, status_code=409)
+    result = status['result']
+    # Batches have a video per source, and a supercut only when asked for.
+    # Speaker searches have no video at all
+    video_url = result.get('video_url') or result.get('supercut_url')
+    if video_url is None:
+        if status.get('kind') != 'batch':
+            return JSONResponse({'error': 'The task has no video, see its result in /task_status'},
+                                status_code=409)
+        return JSONResponse({
+            'error': 'The batch has no supercut, get each video from /result/<task_id>',
+            'task_ids': status.get('task_ids', []),
+        }, status_code=409)
+    return RedirectResponse(video_url)
+
+
+class EventBroker:
+    """One Redis subscription per process, fanned out to the open streams
+
+    Channels are subscribed while at least one stream listens to them, and
+    every message is put on the queue of each of those streams.
+    """
+
+    def __init__(self, redis_client):
+        self.pubsub = redis_client.pubsub()
+        self.queues = {}  # channel -> queues of its streams
+        self.lock = asyncio.Lock()
+        self.subscribed = asyncio.Event()
+        self.reader = None
+
+    def start(self):
+        self.reader = asyncio.create_task(self.read())
+
+    async def stop(self):
+        if self.reader:
+            self.reader.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.reader
+        await self.pubsub.aclose()
+
+    async def subscribe(self, channel):
+        queue = asyncio.Queue()
+        async with self.lock:
+            # Listen before subscribing so no message of the channel is missed
+            if channel in self.queues:
+                self.queues[channel].add(queue)
+                return queue
+            self.queues[channel] = {queue}
+            try:
+                await self.pubsub.subscribe(channel)
+            except Exception:
+                del self.queues[channel]
+                raise
+            self.subscribed.set()
+        return queue
+
+    async def unsubscribe(self, channel, queue):
+        async with self.lock:
+            queues = self.queues.get(channel)
+            if queues is None:
+                return
+            queues.discard(queue)
+            if not queues:
+                del self.queues[channel]
+                await self.pubsub.unsubscribe(channel)
+
+    async def read(self):
+        # The pub/sub connection only exists after the first subscribe
+        await self.subscribed.wait()
+        while True:
+            try:
+                message = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                # The connection resubscribes its channels when it reconnects
+                print(f"Error reading events: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            channel = message['channel'].decode()
+            event = json.loads(message['data'])
+            for queue in self.queues.get(channel, ()):
+                queue.put_nowait(event)
+
+
+def terminal_event(status):
+    """The event a finished task published last, rebuilt from its hash"""
+    if status is None:
+        return None
+    event_type = TERMINAL_STATE_EVENTS.get(status['state'])
+    if event_type is None:
+        return None
+    return {'data': status, 'type': event_type}
+
+
+async def stream(request):
+    """Stream server-sent events published to a Redis channel"""
+    channel = request.query_params.get('channel') or 'sse'
+    broker = request.app.state.events
+
+    async def events():
+        queue = await broker.subscribe(channel)
+        try:
+            # A task that finished before the subscription went through
+            # won't publish again, its channel is the task id
+            event = terminal_event(await request.app.state.tasks.get(channel))
+            if event:
+                yield format_event(event)
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    # Comment lines keep proxies from closing idle streams
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(event)
+                if event.get('type') in TERMINAL_EVENTS:
+                    break
+        finally:
+            await broker.unsubscribe(channel, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+async def prune_uploads(redis_client):
+    """Remove the files of upload sessions that expired without being claimed"""
+    upload_ids = await anyio.to_thread.run_sync(stale_uploads)
+    if not upload_ids:
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for upload_id in upload_ids:
+            pipe.exists(upload_key(upload_id))
+        live = await pipe.execute()
+    for upload_id, exists in zip(upload_ids, live):
+        if not exists:
+            try:
+                await anyio.Path(upload_path(upload_id)).unlink()
+            except FileNotFoundError:
+                continue
+
+
+async def create_upload(request):
+    """Open an upload session for a video file sent in chunks"""
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        body = {}
+    filename = secure_filename(body.get('filename') or '')
+    size = body.get('size')
+
+    if not filename or not allowed_video_file(filename):
+        return JSONResponse({'error': 'Invalid video file format'}, status_code=400)
+    if not isinstance(size, int) or size <= 0:
+        return JSONResponse({'error': 'Invalid file size'}, status_code=400)
+    if size > MAX_CONTENT_LENGTH:
+        return JSONResponse({'error': 'File is too large'}, status_code=413)
+
+    await prune_uploads(request.app.state.redis)
+    upload_id = str(uuid.uuid4())
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    await anyio.Path(upload_path(upload_id)).touch()
+
+    async with request.app.state.redis.pipeline(transaction=True) as pipe:
+        pipe.hset(upload_key(upload_id), mapping={
+            'filename': filename,
+            'size': size,
+            'received': 0
+        })
+        pipe.expire(upload_key(upload_id), UPLOAD_TTL)
+        await pipe.execute()
+
+    return JSONResponse({'upload_id': upload_id}, status_code=201)
+
+
+async def upload_status(request):
+    upload_id = request.path_params['upload_id']
+    session = await request.app.state.redis.hgetall(upload_key(upload_id))
+    if not session:
+        return JSONResponse({'error': 'Unknown upload'}, status_code=404)
+
+    size = int(session[b'size'])
+    received = int(session[b'received'])
+    return JSONResponse({
+        'upload_id': upload_id,
+        'size': size,
+        'received': received,
+        'complete': received == size
+    })
+
+
+async def upload_chunk(request):
+    """Append a chunk to an upload session at the given byte offset"""
+    upload_id = request.path_params['upload_id']
+    redis_client = request.app.state.redis
+    session = await redis_client.hgetall(upload_key(upload_id))
+    if not session:
+        return JSONResponse({'error': 'Unknown upload'}, status_code=404)
+
+    size = int(session[b'size'])
+    received = int(session[b'received'])
+    try:
+        offset = int(request.query_params.get('offset', received))
+    except ValueError:
+        return JSONResponse({'error': 'Invalid offset'}, status_code=400)
+    if offset != received:
+        # Clients resume from the offset reported by GET /uploads/<id>
+        return JSONResponse({'error': 'Unexpected offset', 'received': received},
+                            status_code=409)
+
+    written = 0
+    # Write at the offset instead of appending so an interrupted chunk is
+    # simply overwritten when the client resumes
+    async with await anyio.open_file(upload_path(upload_id), 'r+b') as f:
+        await f.seek(offset)
+        async for chunk in request.stream():
+            if offset + written + len(chunk) > size:
+                return JSONResponse({'error': 'Upload exceeds declared size'},
+                                    status_code=413)
+            await f.write(chunk)
+            written += len(chunk)
+
+    received = offset + written
+    await redis_client.hset(upload_key(upload_id), 'received', received)
+    await redis_client.expire(upload_key(upload_id), UPLOAD_TTL)
+    return JSONResponse({
+        'upload_id': upload_id,
+        'received': received,
+        'complete': received == size
+    })
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.redis = aioredis.from_url(REDIS_URL)
+    app.state.tasks = AsyncTaskStore(app.state.redis)
+    app.state.events = EventBroker(app.state.redis)
+    app.state.events.start()
+    yield
+    await app.state.events.stop()
+    await app.state.redis.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/task_status', batch_task_status, methods=['POST']),
+        Route('/task_status/{task_id}', task_status, methods=['GET']),
+        Route('/result/{task_id}', task_result, methods=['GET']),
+        Route('/stream', stream, methods=['GET']),
+        Route('/uploads', create_upload, methods=['POST']),
+        Route('/uploads/{upload_id}', upload_status, methods=['GET']),
+        Route('/uploads/{upload_id}', upload_chunk, methods=['PUT']),
+        # Job submission and the remaining routes stay on the Flask app
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'],
+                   allow_methods=['*'], allow_headers=['*']),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,47 @@
+"""
+Per-worker memory report for a running gunicorn server (Linux only).
+
+    python bench_memory.py <gunicorn master pid>
+
+RSS counts every page a worker maps, including pages shared with the master
+and its siblings. PSS splits shared pages between the processes using them,
+so the PSS total is what the node actually pays for the whole server.
+"""
+
+import sys
+
+FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+
+def child_pids(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def memory_usage(pid):
+    """Memory counters of a process in MiB, from /proc/<pid>/smaps_rollup"""
+    usage = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in FIELDS:
+                usage[key] = int(value.split()[0]) / 1024
+    return usage
+
+
+def report(master_pid):
+    pids = [master_pid] + child_pids(master_pid)
+    print(f"{'pid':>8} " + " ".join(f"{field:>14}" for field in FIELDS))
+    totals = dict.fromkeys(FIELDS, 0.0)
+    for pid in pids:
+        usage = memory_usage(pid)
+        for field in FIELDS:
+            totals[field] += usage.get(field, 0.0)
+        print(f"{pid:>8} " + " ".join(f"{usage.get(field, 0.0):>14.1f}" for field in FIELDS))
+    print(f"{'total':>8} " + " ".join(f"{totals[field]:>14.1f}" for field in FIELDS))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or not sys.platform.startswith('linux'):
+        sys.exit(__doc__)
+    report(int(sys.argv[1]))
@@ -0,0 +1,84 @@
+"""
+Startup benchmark.
+
+Measures, in fresh interpreters, how long it takes to import the web tier
+(`asgi`, which pulls in the Flask app) compared to the processing stack,
+and optionally how long a server takes from launch until /ready succeeds.
+
+    python bench_startup.py [--runs 5] [--serve]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def time_import(module):
+    """Seconds to import `module` in a new Python process"""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+        cwd=SERVER_DIR,
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def time_until_ready(port, timeout=120):
+    """Seconds from launching uvicorn until /ready answers 200"""
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--port", str(port), "asgi:app"],
+        cwd=SERVER_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready") as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(0.05)
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(name, samples):
+    print(f"{name:<24} median {statistics.median(samples):6.2f}s  "
+          f"min {min(samples):6.2f}s  max {max(samples):6.2f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure server startup time")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--serve', action='store_true',
+                        help='also measure launch-to-ready time (needs Redis)')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    report("import asgi (web tier)", [time_import("asgi") for _ in range(args.runs)])
+    report("import processing", [time_import("processing") for _ in range(args.runs)])
+
+    if args.serve:
+        samples = [time_until_ready(args.port) for _ in range(args.runs)]
+        if None in samples:
+            print("server did not become ready")
+        else:
+            report("launch until /ready", samples)
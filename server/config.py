@@ -0,0 +1,35 @@
+"""
+Application configuration, read from the environment (and `.env`).
+
+Kept free of heavy imports so every entry point can load it cheaply.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+# Load .env file
+load_dotenv()
+
+ALLOWED_AUDIO_EXTENSIONS = {'wav', 'mp3'}
+ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv'}
+S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
+AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
+AWS_REGION = os.getenv("AWS_REGION")
+HF_TOKEN = os.getenv("HF_TOKEN")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
+MAX_CONTENT_LENGTH = 20 * 1024 * 1024  # 20MB max file size
+# Cosine distance under which a diarized speaker matches the reference
+MATCH_THRESHOLD = 0.3
+# Videos per batch job, and how many of them may be queued or run at once
+MAX_BATCH_VIDEOS = 50
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 2))
+# Run the environment checks from preflight.py when the app is created
+RUN_PREFLIGHT_ON_STARTUP = os.getenv("RUN_PREFLIGHT_ON_STARTUP") == "1"
+# How worker processes share the model weights, see models.py
+MODEL_SHARING = os.getenv("MODEL_SHARING", "mmap")
+# Start the job worker pool when the app is created. gunicorn.conf.py turns
+# this off, since the app is imported in the master, and starts the pool in
+# every worker after the fork instead
+START_TASK_PROCESSOR = os.getenv("START_TASK_PROCESSOR", "1") == "1"
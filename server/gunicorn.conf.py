@@ -0,0 +1,46 @@
+"""
+Gunicorn settings for serving the ASGI app with several worker processes.
+
+    gunicorn -c gunicorn.conf.py asgi:app
+
+By default (MODEL_SHARING=mmap) the workers start right away and load the
+models on their first job, sharing the weights through memory-mapped files.
+
+With MODEL_SHARING=fork the models are loaded and frozen in the master
+before the workers are forked, so every worker shares the same weight pages
+copy-on-write. No worker accepts connections until the load is done, so
+health checks fail for as long as the models take to download and load. If
+the load fails (no HF_TOKEN, the hub is unreachable) the workers start
+anyway and load the models on their first job.
+"""
+
+import os
+
+# The app is imported in the master (preload_app), the job worker pool is
+# started in each worker by post_fork
+os.environ["START_TASK_PROCESSOR"] = "0"
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master once the sockets are bound, before any fork
+    from config import MODEL_SHARING
+    if MODEL_SHARING != 'fork':
+        return
+    import models
+    if models.sharing_mode() != 'fork':
+        return
+    try:
+        models.preload()
+    except Exception as e:
+        server.log.error(f"Error preloading models, workers will load them lazily: {e}")
+
+
+def post_fork(server, worker):
+    # Every worker runs its own job worker pool, the master runs none
+    from app import app, start_task_processor
+    start_task_processor(app)
@@ -0,0 +1,130 @@
+"""
+Process-wide registry of the pretrained models.
+
+Models are loaded once per process instead of once per job. How the weights
+are shared between worker processes is set with MODEL_SHARING:
+
+    mmap  (default) every process loads the models on its first job, then
+          swaps the weights for tensors memory-mapped from MODEL_CACHE_DIR,
+          so all processes share the same page cache pages
+    fork  load and freeze the models in the gunicorn master before workers
+          are forked (see gunicorn.conf.py), workers share the weight pages
+          copy-on-write. Opt-in, since no worker serves until the load is
+          done. Falls back to mmap where forking isn't safe (CUDA)
+    off   plain per-process copies
+"""
+
+import gc
+import os
+import re
+import tempfile
+import threading
+
+import torch
+from pyannote.audio import Pipeline, Model
+
+from config import HF_TOKEN, MODEL_SHARING
+
+DIARIZATION_MODEL = "pyannote/speaker-diarization"
+EMBEDDING_MODEL = "pyannote/embedding"
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", os.path.join(
+    tempfile.gettempdir(), 'snipclips-models'))
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def get_device():
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def sharing_mode():
+    # A CUDA context doesn't survive fork, fall back to memory-mapped weights
+    if MODEL_SHARING == 'fork' and torch.cuda.is_available():
+        return 'mmap'
+    return MODEL_SHARING
+
+
+def find_modules(obj, depth=2):
+    """Collect the torch modules held by a model or pipeline"""
+    if isinstance(obj, torch.nn.Module):
+        return [obj]
+    if depth == 0 or not hasattr(obj, '__dict__'):
+        return []
+    modules = []
+    for value in vars(obj).values():
+        modules.extend(find_modules(value, depth - 1))
+    return modules
+
+
+def freeze(obj):
+    """Switch a model to inference only so its weights are never written"""
+    for module in find_modules(obj):
+        module.eval()
+        module.requires_grad_(False)
+
+
+def map_weights(name, obj):
+    """Replace the weights of `obj` with tensors memory-mapped from disk"""
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    for index, module in enumerate(find_modules(obj)):
+        path = os.path.join(MODEL_CACHE_DIR, f"{name}-{index}.pt")
+        if not os.path.exists(path):
+            # Write then rename so concurrent workers never read a partial file
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save(module.state_dict(), temp_path)
+            os.replace(temp_path, path)
+        state = torch.load(path, mmap=True, weights_only=True,
+                           map_location='cpu')
+        module.load_state_dict(state, assign=True)
+
+
+def _load(name, loader):
+    with _lock:
+        if name not in _registry:
+            print(f"Loading model {name} in process {os.getpid()}")
+            model = loader()
+            freeze(model)
+            if sharing_mode() == 'mmap':
+                map_weights(re.sub(r'\W+', '-', name), model)
+            if get_device().type != 'cpu':
+                model.to(get_device())
+            _registry[name] = model
+        return _registry[name]
+
+
+def _load_diarization_pipeline():
+    pipeline = Pipeline.from_pretrained(
+        DIARIZATION_MODEL, use_auth_token=HF_TOKEN)
+    pipeline.instantiate({
+        "segmentation": {
+            "min_duration_off": 0.8,
+            "threshold": 0.55
+        },
+        # "clustering": {
+        #     "method": "fast",
+        #     "min_cluster_size": 10
+        # }
+    })
+    return pipeline
+
+
+def get_diarization_pipeline():
+    return _load(DIARIZATION_MODEL, _load_diarization_pipeline)
+
+
+def get_embedding_model():
+    return _load(EMBEDDING_MODEL, lambda: Model.from_pretrained(
+        EMBEDDING_MODEL, use_auth_token=HF_TOKEN))
+
+
+def preload():
+    """Load every model, then freeze the heap so forked workers share it"""
+    get_diarization_pipeline()
+    get_embedding_model()
+    # Move everything allocated so far out of the collector's reach, so
+    # garbage collection in the workers doesn't touch (and copy) those pages
+    gc.collect()
+    gc.freeze()
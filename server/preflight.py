@@ -0,0 +1,83 @@
+"""
+Environment checks, run ahead of serving instead of at import time.
+
+    python preflight.py                 # check ffmpeg, Redis and settings
+    python preflight.py --install       # install ffmpeg/Redis when missing
+    python preflight.py --start-redis   # start the local Redis server
+    python preflight.py --warm-models   # load the ML stack and fetch weights
+
+Exits with a non-zero status when a required check fails.
+"""
+
+import argparse
+import shutil
+import sys
+
+from config import HF_TOKEN, S3_BUCKET_NAME
+from setup import (check_ffmpeg_installed, install_ffmpeg,
+                   check_redis_installed, install_redis, start_redis_server)
+
+
+def warm_models():
+    """Import the processing stack and download the pretrained weights"""
+    import models
+    models.get_diarization_pipeline()
+    models.get_embedding_model()
+
+
+def run_preflight(install=False, start_redis=False, load_models=False):
+    """Check (and optionally set up) the environment, return True if usable"""
+    if install:
+        install_ffmpeg()
+        if not check_redis_installed():
+            install_redis()
+    if start_redis:
+        start_redis_server()
+
+    checks = {
+        'ffmpeg': check_ffmpeg_installed(),
+        'ffprobe': shutil.which('ffprobe') is not None,
+        'redis': check_redis_installed(),
+        'hf_token': bool(HF_TOKEN),
+        's3_bucket': bool(S3_BUCKET_NAME),
+    }
+    if load_models:
+        try:
+            warm_models()
+            checks['models'] = True
+        except Exception as e:
+            print(f"Error loading models: {e}")
+            checks['models'] = False
+
+    for name, ok in checks.items():
+        print(f"[{'ok' if ok else 'FAIL'}] {name}")
+    return all(checks.values())
+
+
+def check_readiness(app):
+    """Cheap checks telling whether this process can accept jobs"""
+    checks = {
+        'ffmpeg': shutil.which('ffmpeg') is not None,
+        'worker': app.scheduler is not None and app.scheduler.is_alive(),
+        'scratch': app.scratch.has_room(),
+    }
+    try:
+        checks['redis'] = bool(app.redis_client.ping())
+    except Exception:
+        checks['redis'] = False
+    return all(checks.values()), checks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--install', action='store_true',
+                        help='install ffmpeg and Redis if they are missing')
+    parser.add_argument('--start-redis', action='store_true',
+                        help='start the local Redis server')
+    parser.add_argument('--warm-models', action='store_true',
+                        help='import the ML stack and download model weights')
+    args = parser.parse_args()
+
+    ok = run_preflight(install=args.install, start_redis=args.start_redis,
+                       load_models=args.warm_models)
+    sys.exit(0 if ok else 1)
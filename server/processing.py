@@ -0,0 +1,235 @@
+"""
+Video and speaker processing pipeline.
+
+This module pulls in the heavy ML and video stack (torch, pyannote, moviepy,
+yt_dlp, boto3). The web tier never imports it at startup; it is loaded by
+the worker pool when the first job runs.
+"""
+
+import os
+import subprocess
+from functools import lru_cache
+
+import boto3
+import yt_dlp
+from moviepy.editor import VideoFileClip, concatenate_videoclips
+from pyannote.audio import Inference
+from pydub import AudioSegment
+from scipy.spatial.distance import cdist
+
+import models
+from config import (AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION,
+                    MAX_CONTENT_LENGTH, MATCH_THRESHOLD)
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """Create the S3 client on first use"""
+    return boto3.client(
+        's3',
+        aws_access_key_id=AWS_ACCESS_KEY,
+        aws_secret_access_key=AWS_SECRET_KEY,
+        region_name=AWS_REGION
+    )
+
+
+def upload_to_s3(file_path, bucket, object_name=None):
+    """Upload a file to S3 bucket and return the public URL"""
+    if object_name is None:
+        object_name = os.path.basename(file_path)
+
+    try:
+        get_s3_client().upload_file(file_path, bucket, object_name)
+        url = f"https://{bucket}.s3.amazonaws.com/{object_name}"
+        return url
+    except Exception as e:
+        print(f"Error uploading to S3: {e}")
+        return None
+
+
+def download_youtube_video(youtube_link, output_path, on_progress=None):
+    output_base = os.path.splitext(output_path)[0]
+    actual_output = output_base + '.mp4'
+    error = {
+        "msg": None
+    }
+
+    def yt_filesize_filter(info_dict):
+        size = info_dict.get('filesize') or info_dict.get('filesize_approx', 0)
+        if size > MAX_CONTENT_LENGTH:
+            error['msg'] = "Failed to process Youtube video. Youtube video size is too large"
+        return error['msg']
+
+    def yt_progress_hook(status):
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        if on_progress and status['status'] == 'downloading' and total:
+            on_progress(status.get('downloaded_bytes', 0) / total)
+
+    ydl_opts = {
+        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/mp4',
+        'outtmpl': actual_output,
+        'match_filter': yt_filesize_filter,
+        'progress_hooks': [yt_progress_hook],
+    }
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        ydl.download([youtube_link])
+    return actual_output, error['msg']
+
+
+def expand_playlist(playlist_url, limit):
+    """Return up to `limit` video URLs of a playlist or a channel's /videos page"""
+    ydl_opts = {
+        'quiet': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': limit,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(playlist_url, download=False)
+
+    urls = []
+    for entry in info.get('entries') or [info]:
+        url = entry.get('webpage_url') or entry.get('url')
+        if url and not url.startswith('http'):
+            url = f"https://www.youtube.com/watch?v={entry.get('id') or url}"
+        if url:
+            urls.append(url)
+    return urls[:limit]
+
+
+def extract_audio_from_video(video_path, audio_path):
+    command = f"ffmpeg -i {video_path} -vn -acodec pcm_s16le -ar 44100 -ac 2 {audio_path} -y"
+    subprocess.call(command, shell=True)
+    return audio_path
+
+
+def get_speaker_embedding(audio_path, embedding_model, batch_size=32):
+    inference = Inference(embedding_model, window="whole",
+                          batch_size=batch_size)
+    embedding = inference(audio_path).reshape(1, -1)
+    return embedding
+
+
+def extract_matching_speaker_segments(video_path, diarization_result, matching_speakers, output_path):
+    video = VideoFileClip(video_path)
+    segments = []
+
+    for speech_turn, _, speaker_label in diarization_result.itertracks(yield_label=True):
+        if speaker_label in matching_speakers:
+            start_time = speech_turn.start
+            end_time = speech_turn.end
+            segment = video.subclip(start_time, end_time)
+            segments.append(segment)
+
+    if not segments:
+        video.close()
+        return None
+
+    final_video = concatenate_videoclips(segments)
+    final_video.write_videofile(
+        output_path,
+        codec='libx264',
+        audio_codec='aac',
+        # Next to the output, concurrent jobs would collide in the working directory
+        temp_audiofile=os.path.join(
+            os.path.dirname(output_path), 'temp-audio.m4a'),
+        remove_temp=True,
+        threads=4
+    )
+
+    video.close()
+    final_video.close()
+    return output_path
+
+
+def embed_reference(reference_audio):
+    """Embed a reference voice once so several jobs can match against it"""
+    return get_speaker_embedding(reference_audio, models.get_embedding_model())
+
+
+def speaker_embeddings(extracted_speakers_dir):
+    """Embed every extracted speaker, keyed by speaker label"""
+    embedding_model = models.get_embedding_model()
+    embeddings = {}
+    for filename in sorted(os.listdir(extracted_speakers_dir)):
+        if not filename.endswith('.wav'):
+            continue
+
+        speaker_path = os.path.join(extracted_speakers_dir, filename)
+        speaker_label = os.path.splitext(filename)[0]
+        embeddings[speaker_label] = get_speaker_embedding(
+            speaker_path, embedding_model)
+    return embeddings
+
+
+def match_speakers(reference_audio, extracted_speakers_dir, threshold=MATCH_THRESHOLD,
+                   reference_embedding=None, embeddings=None):
+    if reference_embedding is None:
+        reference_embedding = embed_reference(reference_audio)
+    if embeddings is None:
+        embeddings = speaker_embeddings(extracted_speakers_dir)
+
+    matching_speakers = set()
+    distances = {}
+
+    for speaker_label, speaker_embedding in embeddings.items():
+        distance = cdist(reference_embedding,
+                         speaker_embedding, metric="cosine")[0, 0]
+        distances[speaker_label] = distance
+
+        if distance <= threshold:
+            matching_speakers.add(speaker_label)
+
+    return matching_speakers, distances
+
+
+def extract_speaker_segments(audio_path, diarization_result, output_dir):
+    audio = AudioSegment.from_wav(audio_path)
+
+    for speech_turn, _, speaker_label in diarization_result.itertracks(yield_label=True):
+        start_time = int(speech_turn.start * 1000)
+        end_time = int(speech_turn.end * 1000)
+
+        segment = audio[start_time:end_time]
+        output_file = os.path.join(output_dir, f"{speaker_label}.wav")
+
+        if not os.path.exists(output_file):
+            segment.export(output_file, format="wav")
+
+
+def diarize(audio_path, hook=None):
+    """Run speaker diarization on a 16kHz mono wav file"""
+    pipeline = models.get_diarization_pipeline()
+    return pipeline(audio_path, hook=hook)
+
+
+def speaker_turns(diarization_result):
+    """Flatten a diarization into a list of (start, end, speaker_label) turns"""
+    return [
+        (speech_turn.start, speech_turn.end, speaker_label)
+        for speech_turn, _, speaker_label in diarization_result.itertracks(yield_label=True)
+    ]
+
+
+def preprocess_audio(input_path, output_path, max_duration=300):
+    """Preprocess audio to reduce size and duration"""
+    try:
+        # Load audio
+        audio = AudioSegment.from_file(input_path)
+
+        # Convert to mono
+        audio = audio.set_channels(1)
+
+        # Downsample to 16kHz
+        audio = audio.set_frame_rate(16000)
+
+        # Limit duration if needed (e.g., 5 minutes)
+        if len(audio) > max_duration * 1000:
+            audio = audio[:max_duration * 1000]
+
+        # Export
+        audio.export(output_path, format='wav')
+        return True
+    except Exception as e:
+        print(f"Error preprocessing audio: {e}")
+        return False
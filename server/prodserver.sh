@@ -3,5 +3,5 @@ PORT="${PORT:-8000}"
 
 python3 -m venv .venv
 source .venv/bin/activate
-gunicorn -b 0.0.0.0:$PORT app:app
+uvicorn --host 0.0.0.0 --port $PORT asgi:app
 
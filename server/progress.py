@@ -0,0 +1,109 @@
+"""
+Progress reporting helpers for the processing pipeline.
+
+Long running steps (audio extraction, diarization, encoding) report their
+completion as a fraction between 0 and 1. The helpers here turn those
+fractions into task percentages and push them to subscribers through the
+same Redis pub/sub channels flask_sse streams from.
+"""
+
+import json
+import subprocess
+
+
+def publish_event(redis_client, channel, data, type=None):
+    """Publish a server-sent event in the message format used by flask_sse"""
+    message = {'data': data}
+    if type:
+        message['type'] = type
+    return redis_client.publish(channel, json.dumps(message))
+
+
+class ProgressRange:
+    """Map the progress of a single step onto a slice of the task percentage"""
+
+    def __init__(self, report, message, start, end):
+        self.report = report
+        self.message = message
+        self.start = start
+        self.end = end
+        self.last_percentage = None
+
+    def __call__(self, fraction):
+        fraction = min(max(fraction, 0.0), 1.0)
+        percentage = int(self.start + (self.end - self.start) * fraction)
+        # Only publish when the visible percentage actually changes
+        if percentage != self.last_percentage:
+            self.last_percentage = percentage
+            self.report(self.message, percentage)
+
+
+class DiarizationProgressHook:
+    """pyannote pipeline hook reporting segmentation and embedding progress"""
+
+    # Share of the diarization step taken by each pipeline stage
+    STEP_WEIGHTS = {
+        'segmentation': (0.0, 0.4),
+        'embeddings': (0.4, 1.0),
+    }
+
+    def __init__(self, on_progress):
+        self.on_progress = on_progress
+
+    def __call__(self, step_name, step_artifact, file=None, total=None, completed=None):
+        if step_name not in self.STEP_WEIGHTS or not total:
+            return
+        start, end = self.STEP_WEIGHTS[step_name]
+        self.on_progress(start + (end - start) * (completed / total))
+
+
+def probe_duration(media_path):
+    """Return the duration of a media file in seconds, or None if unknown"""
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", media_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=False
+        )
+    except FileNotFoundError:
+        return None
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+
+def run_ffmpeg(args, duration=None, on_progress=None):
+    """Run ffmpeg and report progress parsed from its `-progress` output"""
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats",
+               "-progress", "pipe:1", *args]
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+
+    try:
+        for line in process.stdout:
+            key, _, value = line.strip().partition('=')
+            if on_progress is None:
+                continue
+            if key == 'out_time_us' and duration and value.isdigit():
+                on_progress(int(value) / 1_000_000 / duration)
+            elif key == 'progress' and value == 'end':
+                on_progress(1.0)
+    except BaseException:
+        # The progress callback may abort the step (e.g. a cancelled task)
+        process.kill()
+        process.wait()
+        raise
+
+    stderr = process.stderr.read()
+    returncode = process.wait()
+    if returncode != 0:
+        print(f"ffmpeg exited with code {returncode}: {stderr.strip()}")
+    return returncode
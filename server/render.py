@@ -0,0 +1,356 @@
+"""
+Segment based renderer.
+
+The matched timeline is split into chunks on an absolute RENDER_CHUNK_SECONDS
+grid, and every chunk is encoded on its own with the same normalized codec
+parameters, so the pieces can be joined with a stream copy instead of
+re-encoding the whole timeline. Chunks are encoded concurrently, each by its
+own ffmpeg process with a few encoder threads, since libx264 scales better
+across processes than across threads.
+
+Encoded chunks are cached per source video, time range and encoding profile
+in RENDER_CACHE_DIR; re-cuts and other jobs on the same video only encode the
+chunks they're missing. The cache is capped at RENDER_CACHE_MAX_BYTES and
+evicts least recently used chunks first.
+"""
+
+import hashlib
+import math
+import os
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from progress import run_ffmpeg
+from scheduler import probe_media, MAX_CONCURRENT_JOBS
+
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", os.path.join(
+    tempfile.gettempdir(), 'snipclips-render-cache'))
+RENDER_CACHE_MAX_BYTES = int(os.getenv(
+    "RENDER_CACHE_MAX_BYTES", 5 * 1024 * 1024 * 1024))  # 5GB
+CACHE_STATS_KEY = "render_cache:stats"
+# Shorter turns would encode to less than a frame
+MIN_SEGMENT_SECONDS = 0.05
+RENDER_CHUNK_SECONDS = float(os.getenv("RENDER_CHUNK_SECONDS", 10))
+# Parallel chunk encoders per job, 0 sizes them from the available cores
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 0))
+ENCODE_THREADS = 2  # libx264 threads per chunk encoder
+
+
+class EncodeProfile:
+    """Codec parameters shared by every segment of a render"""
+
+    def __init__(self, name, preset, crf, cpu_factor, audio_bitrate='128k', height=None):
+        self.name = name
+        self.preset = preset
+        self.crf = crf
+        # Encoding cost relative to the ultrafast preset, for the scheduler
+        self.cpu_factor = cpu_factor
+        self.audio_bitrate = audio_bitrate
+        # Downscale to this height (never upscale), None keeps the source size
+        self.height = height
+
+    def cache_tag(self):
+        return f"{self.name}:{self.preset}:{self.crf}:{self.audio_bitrate}:{self.height}"
+
+    def filter_args(self):
+        if self.height is None:
+            return []
+        return ["-vf", f"scale=-2:'min({self.height},ih)'"]
+
+    def output_args(self):
+        return [
+            "-c:v", "libx264", "-preset", self.preset, "-crf", str(self.crf),
+            "-pix_fmt", "yuv420p", "-video_track_timescale", "90000",
+            "-c:a", "aac", "-b:a", self.audio_bitrate, "-ar", "48000", "-ac", "2",
+        ]
+
+
+# Jobs pick a profile with their `quality` flag
+PROFILES = {
+    'latency': EncodeProfile('latency', preset='ultrafast', crf=23, cpu_factor=1.0),
+    'balanced': EncodeProfile('balanced', preset='veryfast', crf=22, cpu_factor=2.0),
+    'quality': EncodeProfile('quality', preset='medium', crf=20, cpu_factor=5.0),
+}
+DEFAULT_QUALITY = 'latency'
+DEFAULT_PROFILE = PROFILES[DEFAULT_QUALITY]
+# Low resolution render for checking a match before the full render is done
+PREVIEW_PROFILE = EncodeProfile('preview', preset='ultrafast', crf=32, cpu_factor=0.2,
+                                audio_bitrate='64k', height=360)
+
+
+class RenderAborted(Exception):
+    """Stops the remaining chunk encoders once one of them failed"""
+
+
+def render_workers():
+    """Chunk encoders per job, splitting the cores between the job slots"""
+    if RENDER_WORKERS:
+        return RENDER_WORKERS
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    return max(cores // MAX_CONCURRENT_JOBS // ENCODE_THREADS, 1)
+
+
+def split_chunks(segments, chunk_seconds=RENDER_CHUNK_SECONDS):
+    """Split segments on an absolute time grid
+
+    The grid doesn't depend on where a turn starts, so re-cuts selecting
+    overlapping turns share most of their cached chunks.
+    """
+    chunks = []
+    for start, end in segments:
+        while True:
+            boundary = (math.floor(start / chunk_seconds) + 1) * chunk_seconds
+            if boundary - start < MIN_SEGMENT_SECONDS:
+                boundary += chunk_seconds
+            if boundary > end - MIN_SEGMENT_SECONDS:
+                chunks.append((start, end))
+                break
+            chunks.append((start, boundary))
+            start = boundary
+    return chunks
+
+
+def source_fingerprint(video_path, sample_size=1024 * 1024):
+    """Cheap identity of a video file: its size plus its first and last MB"""
+    size = os.path.getsize(video_path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(video_path, 'rb') as f:
+        digest.update(f.read(sample_size))
+        f.seek(max(size - sample_size, 0))
+        digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+class SegmentCache:
+    def __init__(self, root=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, source_id, start, end, profile):
+        # Millisecond precision keeps float noise out of the key
+        raw = f"{source_id}:{start:.3f}:{end:.3f}:{profile.cache_tag()}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.mp4")
+
+    def get(self, key):
+        """Return the cached segment's path, or None on a miss"""
+        path = self.path(key)
+        try:
+            # Touch the segment so eviction sees it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def temp_path(self):
+        """Where to encode a new segment, on the cache's volume so put() is a rename"""
+        return os.path.join(self.root, f"tmp_{uuid.uuid4()}.mp4")
+
+    def put(self, key, segment_path):
+        path = self.path(key)
+        os.replace(segment_path, path)
+        return path
+
+    def size(self):
+        entries = self.entries()
+        return len(entries), sum(size for _, _, size in entries)
+
+    def entries(self):
+        entries = []
+        with os.scandir(self.root) as scan:
+            for entry in scan:
+                if not entry.name.endswith('.mp4') or entry.name.startswith('tmp_'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def evict(self, keep=()):
+        """Remove the least recently used segments until under the size cap"""
+        entries = sorted(self.entries())
+        total = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                continue
+
+
+def encode_segment(video_path, start, end, output_path, profile, on_progress=None):
+    returncode = run_ffmpeg(
+        ["-ss", f"{start:.3f}", "-i", video_path, "-t", f"{end - start:.3f}",
+         "-map", "0:v:0", "-map", "0:a:0?",
+         *profile.filter_args(), *profile.output_args(),
+         "-threads", str(ENCODE_THREADS),
+         "-avoid_negative_ts", "make_zero", output_path, "-y"],
+        duration=end - start,
+        on_progress=on_progress
+    )
+    if returncode != 0:
+        raise Exception(f'Failed to encode segment {start:.2f}-{end:.2f}')
+
+
+def concat_segments(segment_paths, output_path, work_dir):
+    """Join segments encoded with the same profile without re-encoding"""
+    list_path = os.path.join(work_dir, f"concat_{uuid.uuid4()}.txt")
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            escaped = path.replace("'", r"'\''")
+            f.write(f"file '{escaped}'\n")
+
+    returncode = run_ffmpeg(
+        ["-f", "concat", "-safe", "0", "-i", list_path,
+         "-c", "copy", "-movflags", "+faststart", output_path, "-y"])
+    os.remove(list_path)
+    if returncode != 0:
+        raise Exception('Failed to join the rendered segments')
+
+
+def render_segments(video_path, segments, output_path, work_dir, cache=None,
+                    profile=DEFAULT_PROFILE, on_progress=None, workers=None):
+    """Render the (start, end) segments of a video into one output file
+
+    Returns the number of cache hits and misses.
+    """
+    segments = [(start, end) for start, end in segments
+                if end - start >= MIN_SEGMENT_SECONDS]
+    if not segments:
+        raise Exception('No segments found for matching speakers')
+
+    cache = cache or SegmentCache()
+    source_id = source_fingerprint(video_path)
+    chunks = split_chunks(segments)
+    keys = [cache.key(source_id, start, end, profile) for start, end in chunks]
+    paths = [cache.get(key) for key in keys]
+    hits = sum(1 for path in paths if path)
+
+    # The same chunk can be selected twice, it is only encoded once
+    missing = {}
+    for key, chunk, path in zip(keys, chunks, paths):
+        if path is None:
+            missing.setdefault(key, chunk)
+
+    total_duration = sum(end - start for start, end in chunks)
+    cached_duration = total_duration - sum(
+        end - start for key, (start, end) in zip(keys, chunks) if key in missing)
+    encoded = {}
+    lock = threading.Lock()
+    aborted = threading.Event()
+
+    def chunk_progress(key, fraction):
+        if aborted.is_set():
+            raise RenderAborted()
+        start, end = missing[key]
+        with lock:
+            encoded[key] = fraction * (end - start)
+            if on_progress:
+                on_progress((cached_duration + sum(encoded.values())) / total_duration)
+
+    def encode(key):
+        start, end = missing[key]
+        temp_path = cache.temp_path()
+        try:
+            encode_segment(video_path, start, end, temp_path, profile,
+                           on_progress=lambda fraction: chunk_progress(key, fraction))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return cache.put(key, temp_path)
+
+    encoded_paths = {}
+    with ThreadPoolExecutor(max_workers=workers or render_workers()) as executor:
+        futures = {executor.submit(encode, key): key for key in missing}
+        try:
+            for future in as_completed(futures):
+                encoded_paths[futures[future]] = future.result()
+        except BaseException:
+            # Stop the running encoders (through their progress callbacks)
+            # and drop the queued ones before re-raising the first error
+            aborted.set()
+            for future in futures:
+                future.cancel()
+            raise
+
+    paths = [path or encoded_paths[key] for key, path in zip(keys, paths)]
+    concat_segments(paths, output_path, work_dir)
+    cache.evict(keep=set(paths))
+    return {'hits': hits, 'misses': len(chunks) - hits}
+
+
+def stitch_videos(video_paths, output_path, work_dir, profile=DEFAULT_PROFILE,
+                  on_progress=None):
+    """Join rendered videos from different sources into one supercut
+
+    Renders share their codec parameters, so videos of the same resolution
+    are joined with a stream copy. Otherwise every video is scaled and padded
+    to the resolution of the first one and the whole supercut is re-encoded.
+    """
+    probes = [probe_media(path) for path in video_paths]
+    resolutions = {probe[1:] if probe else None for probe in probes}
+    if len(resolutions) == 1 and None not in resolutions:
+        concat_segments(video_paths, output_path, work_dir)
+        return
+
+    width, height = next(
+        (probe[1:] for probe in probes if probe), (1280, 720))
+    inputs = []
+    filters = []
+    for index, path in enumerate(video_paths):
+        inputs += ["-i", path]
+        filters.append(
+            f"[{index}:v]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps=30[v{index}];"
+            f"[{index}:a]aresample=48000[a{index}]")
+    streams = "".join(f"[v{index}][a{index}]" for index in range(len(video_paths)))
+    filters.append(f"{streams}concat=n={len(video_paths)}:v=1:a=1[v][a]")
+
+    returncode = run_ffmpeg(
+        [*inputs, "-filter_complex", ";".join(filters),
+         "-map", "[v]", "-map", "[a]", *profile.output_args(),
+         "-movflags", "+faststart", output_path, "-y"],
+        duration=sum(probe[0] for probe in probes if probe) or None,
+        on_progress=on_progress
+    )
+    if returncode != 0:
+        raise Exception('Failed to stitch the supercut')
+
+
+def record_cache_stats(redis_client, stats):
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hincrby(CACHE_STATS_KEY, 'hits', stats['hits'])
+        pipe.hincrby(CACHE_STATS_KEY, 'misses', stats['misses'])
+        pipe.execute()
+
+
+def cache_stats(redis_client, cache=None):
+    """Hit rate across all workers, and this node's cache size"""
+    cache = cache or SegmentCache()
+    counters = redis_client.hgetall(CACHE_STATS_KEY)
+    hits = int(counters.get(b'hits', 0))
+    misses = int(counters.get(b'misses', 0))
+    entries, size = cache.size()
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else None,
+        'entries': entries,
+        'size_bytes': size,
+        'max_bytes': cache.max_bytes,
+    }
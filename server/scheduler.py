@@ -0,0 +1,534 @@
+"""
+Cost-aware job scheduler.
+
+Jobs are probed at submit time (duration and resolution) to estimate their
+CPU-seconds and peak memory. Queued jobs run shortest-job-first, with their
+estimated cost reduced by AGING_RATE for every second they wait so large
+jobs can't starve. A job is only admitted while the estimated peak memory
+of the running jobs stays within MEMORY_BUDGET_MB. If the job at the head
+of the queue doesn't fit, nothing else is admitted until it does. The same
+goes for the disk and fast volume scratch space a job reserves (see
+scratch.py).
+
+Speaker searches only embed a short recording, so they run in a lane of
+their own with SEARCH_JOB_SLOTS slots and SEARCH_MEMORY_MB of the budget
+set aside, instead of waiting behind full video jobs.
+
+The queues, the budget and the job slots are per node, kept in Redis under
+scheduler:{SCHEDULER_NODE}, so every worker process of a gunicorn server
+takes part in the same schedule.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from progress import probe_duration
+from tasks import QUEUE_FIELDS, TERMINAL_STATES
+
+MEMORY_BUDGET_MB = int(os.getenv("SCHEDULER_MEMORY_BUDGET_MB", 8 * 1024))
+MAX_CONCURRENT_JOBS = int(os.getenv("SCHEDULER_MAX_CONCURRENT_JOBS", 2))
+# The speaker search lane, its memory is taken out of MEMORY_BUDGET_MB
+SEARCH_JOB_SLOTS = int(os.getenv("SCHEDULER_SEARCH_JOB_SLOTS", 1))
+SEARCH_MEMORY_MB = int(os.getenv("SCHEDULER_SEARCH_MEMORY_MB", 1024))
+# Seconds of estimated cost forgiven for every second a job waits
+AGING_RATE = float(os.getenv("SCHEDULER_AGING_RATE", 1.0))
+# Worker processes sharing a node id share its budget and job slots
+SCHEDULER_NODE = os.getenv("SCHEDULER_NODE") or socket.gethostname()
+LEASE_SECONDS = 30
+UNLIMITED_MB = 2 ** 40
+ADMIT_POLL_SECONDS = 1
+
+# Cost model, per second of input media
+DIARIZATION_CPU_SECONDS = 0.5
+ENCODE_CPU_SECONDS_720P = 1.0  # ultrafast preset, scaled by the number of pixels
+BASE_MEMORY_MB = 1500
+RENDER_MEMORY_MB = 500
+MEMORY_MB_PER_MINUTE = 40
+SCRATCH_MB_PER_MINUTE_720P = 50  # source or rendered video
+AUDIO_MB_PER_MINUTE = 2  # 16kHz mono wav
+EMBEDDING_CPU_SECONDS = 0.1
+EMBEDDING_MEMORY_MB = 800
+DEFAULT_DURATION = 10 * 60  # assumed when probing fails
+DEFAULT_RESOLUTION = (1280, 720)
+
+
+class JobEstimate:
+    def __init__(self, duration, width, height, render_only=False, encode_factor=1.0,
+                 embed_only=False):
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.lane = 'search' if embed_only else 'video'
+        # Slower encoder presets multiply the encoding cost
+        encode_seconds = ENCODE_CPU_SECONDS_720P * encode_factor * (
+            (width * height) / (1280 * 720))
+        video_mb = SCRATCH_MB_PER_MINUTE_720P * (width * height) / (1280 * 720)
+        # Scratch is split between the disk (videos) and the fast volume
+        # (audio and intermediates), see scratch.py
+        if embed_only:
+            # Speaker searches only embed a reference recording
+            self.cpu_seconds = duration * EMBEDDING_CPU_SECONDS
+            self.memory_mb = EMBEDDING_MEMORY_MB
+            self.disk_mb = AUDIO_MB_PER_MINUTE * duration / 60
+            self.fast_mb = 0
+        elif render_only:
+            # Re-cuts skip download, diarization and embedding
+            self.cpu_seconds = duration * encode_seconds
+            self.memory_mb = RENDER_MEMORY_MB
+            self.disk_mb = video_mb * duration / 60
+            self.fast_mb = 0
+        else:
+            self.cpu_seconds = duration * (DIARIZATION_CPU_SECONDS + encode_seconds)
+            self.memory_mb = BASE_MEMORY_MB + MEMORY_MB_PER_MINUTE * duration / 60
+            # The source plus the rendered output, then the extracted audio
+            # and the speaker segments cut from it
+            self.disk_mb = 2 * video_mb * duration / 60
+            self.fast_mb = 2 * AUDIO_MB_PER_MINUTE * duration / 60
+
+    def keep_on_disk(self):
+        """Account for a job whose audio and intermediates stay on disk"""
+        self.disk_mb += self.fast_mb
+        self.fast_mb = 0
+
+    def wall_seconds(self):
+        """Expected run time when the node's cores are split between the job slots"""
+        cores = max((os.cpu_count() or 1) // MAX_CONCURRENT_JOBS, 1)
+        return self.cpu_seconds / cores
+
+    def to_fields(self):
+        return {
+            'estimated_cpu_seconds': int(self.cpu_seconds),
+            'estimated_memory_mb': int(self.memory_mb),
+            'estimated_scratch_mb': int(self.disk_mb + self.fast_mb),
+        }
+
+
+def probe_media(media_path):
+    """Return (duration, width, height) of a local video file"""
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+             "-show_entries", "stream=width,height:format=duration",
+             "-of", "json", media_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=False
+        )
+    except FileNotFoundError:
+        return None
+    try:
+        info = json.loads(result.stdout)
+        stream = info['streams'][0]
+        return float(info['format']['duration']), stream['width'], stream['height']
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+def probe_youtube(youtube_url):
+    """Return (duration, width, height) of a YouTube video without downloading it"""
+    import yt_dlp
+
+    try:
+        with yt_dlp.YoutubeDL({'quiet': True, 'skip_download': True}) as ydl:
+            info = ydl.extract_info(youtube_url, download=False)
+        return float(info['duration']), info.get('width') or 0, info.get('height') or 0
+    except Exception as e:
+        print(f"Error probing YouTube video: {e}")
+        return None
+
+
+def estimate_job(youtube_url=None, video_file_path=None, encode_factor=1.0):
+    probe = None
+    if youtube_url:
+        probe = probe_youtube(youtube_url)
+    elif video_file_path:
+        probe = probe_media(video_file_path)
+
+    duration, width, height = probe or (DEFAULT_DURATION, *DEFAULT_RESOLUTION)
+    if not width or not height:
+        width, height = DEFAULT_RESOLUTION
+    return JobEstimate(duration, width, height, encode_factor=encode_factor)
+
+
+def estimate_render(video_path, duration, encode_factor=1.0):
+    """Estimate a job that only renders `duration` seconds of a local video"""
+    probe = probe_media(video_path)
+    width, height = probe[1:] if probe else DEFAULT_RESOLUTION
+    return JobEstimate(duration, width, height, render_only=True,
+                       encode_factor=encode_factor)
+
+
+def estimate_embedding(audio_path):
+    """Estimate a job that only embeds a reference recording"""
+    duration = probe_duration(audio_path) or DEFAULT_DURATION
+    return JobEstimate(duration, *DEFAULT_RESOLUTION, embed_only=True)
+
+
+# Forget the jobs of processes that stopped renewing their leases, returns
+# the id and the stored job of each, for the caller to fail them.
+# KEYS: running, jobs, leases, then the queue of each lane
+# ARGV: now
+EXPIRE_SCRIPT = """
+local expired = {}
+for _, id in ipairs(redis.call('zrangebyscore', KEYS[3], '-inf', ARGV[1])) do
+    table.insert(expired, id)
+    table.insert(expired, redis.call('hget', KEYS[2], id) or '{}')
+    redis.call('srem', KEYS[1], id)
+    redis.call('hdel', KEYS[2], id)
+    redis.call('zrem', KEYS[3], id)
+    for i = 4, #KEYS do
+        redis.call('zrem', KEYS[i], id)
+    end
+end
+return expired
+"""
+
+
+# Admit a queued job if it's at the head of its lane's queue and fits.
+# Returns 1 if admitted, 0 if not yet and -1 if the job isn't queued.
+# Slots and memory are per lane, scratch is shared by both.
+# KEYS: lane queue, running, jobs, leases
+# ARGV: task id, now, lease expiry, lane slots, lane memory budget,
+#       disk and fast scratch capacity, disk and fast volume free space (MB)
+ADMIT_SCRIPT = """
+local raw = redis.call('hget', KEYS[3], ARGV[1])
+if not raw then
+    return -1
+end
+if redis.call('zrange', KEYS[1], 0, 0)[1] ~= ARGV[1] then
+    return 0
+end
+local job = cjson.decode(raw)
+local running = redis.call('smembers', KEYS[2])
+-- A job larger than its lane's budget still runs, but only on its own
+if #running > 0 then
+    local lane_jobs, memory, disk, fast = 0, job.memory_mb, job.disk_mb, job.fast_mb
+    for _, id in ipairs(running) do
+        local other = redis.call('hget', KEYS[3], id)
+        if other then
+            other = cjson.decode(other)
+            if (other.lane or 'video') == job.lane then
+                lane_jobs = lane_jobs + 1
+                memory = memory + other.memory_mb
+            end
+            disk = disk + other.disk_mb
+            fast = fast + other.fast_mb
+        end
+    end
+    if lane_jobs >= tonumber(ARGV[4]) then
+        return 0
+    end
+    if lane_jobs > 0 and memory > tonumber(ARGV[5]) then
+        return 0
+    end
+    -- Scratch is reserved up front, what running jobs wrote is part of
+    -- their reservation. The volumes must still have room for this job
+    if disk > tonumber(ARGV[6]) or fast > tonumber(ARGV[7]) or
+            job.disk_mb > tonumber(ARGV[8]) or job.fast_mb > tonumber(ARGV[9]) then
+        return 0
+    end
+end
+
+job.started_at = tonumber(ARGV[2])
+redis.call('hset', KEYS[3], ARGV[1], cjson.encode(job))
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('sadd', KEYS[2], ARGV[1])
+redis.call('zadd', KEYS[4], ARGV[3], ARGV[1])
+return 1
+"""
+
+
+def scheduler_key(name):
+    return f"scheduler:{SCHEDULER_NODE}:{name}"
+
+
+def queue_key(lane):
+    # The video lane keeps the key it had before lanes existed
+    return scheduler_key('queue' if lane == 'video' else f'{lane}_queue')
+
+
+class QueuedJob:
+    def __init__(self, task, estimate):
+        self.task = task
+        self.estimate = estimate
+        self.submitted_at = time.time()
+        self.started_at = None
+
+    def priority(self):
+        # Aging lowers the cost by the same amount per second for every job,
+        # so crediting the submit time gives the same order at any moment
+        return self.estimate.cpu_seconds + AGING_RATE * self.submitted_at
+
+    def to_json(self):
+        return json.dumps({
+            'lane': self.estimate.lane,
+            # Released if the job's process dies, see Scheduler.expire_leases
+            'fingerprint': getattr(self.task, 'fingerprint', None),
+            'memory_mb': self.estimate.memory_mb,
+            'disk_mb': self.estimate.disk_mb,
+            'fast_mb': self.estimate.fast_mb,
+            'wall_seconds': self.estimate.wall_seconds(),
+        })
+
+
+class Scheduler:
+    """Runs queued VideoProcessor tasks on a pool of worker threads
+
+    Every worker process on a node has its own pool, but the queue order,
+    the job slots and the memory budget are shared through Redis. A process
+    only runs the jobs submitted to it, once they reach the head of their
+    lane's queue on the node and fit. Processes renew leases on their jobs,
+    so the jobs of a process that died are dropped after LEASE_SECONDS.
+    """
+
+    def __init__(self, tasks, memory_budget_mb=MEMORY_BUDGET_MB,
+                 max_concurrent=MAX_CONCURRENT_JOBS, scratch=None,
+                 search_slots=SEARCH_JOB_SLOTS, search_memory_mb=SEARCH_MEMORY_MB):
+        self.tasks = tasks
+        self.redis_client = tasks.redis_client
+        self.scratch = scratch
+        self.memory_budget_mb = memory_budget_mb
+        self.max_concurrent = max_concurrent
+        # Slots and memory budget of each lane
+        self.lanes = {
+            'video': (max_concurrent, max(memory_budget_mb - search_memory_mb, 0)),
+            'search': (search_slots, search_memory_mb),
+        }
+        self.admit_script = self.redis_client.register_script(ADMIT_SCRIPT)
+        self.expire_script = self.redis_client.register_script(EXPIRE_SCRIPT)
+        self.condition = threading.Condition()
+        self.queued = []
+        self.running = {}
+        self.stopped = False
+        self.workers = []
+
+    def keys(self, lane='video'):
+        return [queue_key(lane)] + [
+            scheduler_key(name) for name in ('running', 'jobs', 'leases')]
+
+    def start(self):
+        # The node can give every job slot of a lane to this process
+        for lane, (slots, _) in self.lanes.items():
+            for _ in range(slots):
+                worker = threading.Thread(target=self.work, args=(lane,))
+                # Make thread daemon so it exits when main thread exits
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        lease_keeper = threading.Thread(target=self.keep_leases)
+        lease_keeper.daemon = True
+        lease_keeper.start()
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join(timeout=timeout)
+
+    def is_alive(self):
+        return any(worker.is_alive() for worker in self.workers)
+
+    def submit(self, task, estimate):
+        self.tasks.update(task.task_id, event_type=None, **estimate.to_fields())
+        job = QueuedJob(task, estimate)
+        self.register(job)
+        with self.condition:
+            self.queued.append(job)
+            self.condition.notify_all()
+        self.publish_queue()
+
+    def register(self, job):
+        """Add a job to its lane's queue on the node"""
+        lane_queue_key, _, jobs_key, leases_key = self.keys(job.estimate.lane)
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(jobs_key, job.task.task_id, job.to_json())
+            pipe.zadd(leases_key, {job.task.task_id: time.time() + LEASE_SECONDS})
+            pipe.zadd(lane_queue_key, {job.task.task_id: job.priority()})
+            pipe.execute()
+
+    def forget(self, task_id):
+        """Remove a job from the node's shared state"""
+        _, running_key, jobs_key, leases_key = self.keys()
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            for lane in self.lanes:
+                pipe.zrem(queue_key(lane), task_id)
+            pipe.srem(running_key, task_id)
+            pipe.hdel(jobs_key, task_id)
+            pipe.zrem(leases_key, task_id)
+            pipe.execute()
+
+    def cancel(self, task_id):
+        """Drop a queued task, returns False if it isn't queued here"""
+        with self.condition:
+            job = next((job for job in self.queued
+                        if job.task.task_id == task_id), None)
+            if job is None:
+                return False
+            self.queued.remove(job)
+        self.forget(task_id)
+        self.publish_queue()
+        job.task.discard()
+        return True
+
+    def prune_cancelled(self):
+        """Drop queued jobs cancelled through another worker process"""
+        if not self.queued:
+            return
+        cancelled_ids = self.tasks.cancelled_among(
+            [job.task.task_id for job in self.queued])
+        cancelled = [
+            job for job in self.queued if job.task.task_id in cancelled_ids
+        ]
+        for job in cancelled:
+            self.queued.remove(job)
+            self.forget(job.task.task_id)
+            job.task.discard()
+        if cancelled:
+            self.publish_queue()
+
+    def keep_leases(self):
+        """Renew the leases of this process's jobs until the scheduler stops"""
+        while not self.stopped:
+            with self.condition:
+                task_ids = [job.task.task_id for job in self.queued]
+                task_ids += list(self.running)
+            if task_ids:
+                expiry = time.time() + LEASE_SECONDS
+                try:
+                    self.redis_client.zadd(
+                        scheduler_key('leases'),
+                        {task_id: expiry for task_id in task_ids}, xx=True)
+                except Exception as e:
+                    print(f"Error renewing job leases: {e}")
+            time.sleep(LEASE_SECONDS / 3)
+
+    def expire_leases(self):
+        """Fail the jobs of processes that died, and release their fingerprints
+
+        Otherwise identical submissions would keep attaching to tasks that
+        never run.
+        """
+        expired = self.expire_script(
+            keys=self.keys()[1:] + [queue_key(lane) for lane in self.lanes],
+            args=[time.time()])
+        for task_id, job in zip(expired[::2], expired[1::2]):
+            task_id = task_id.decode()
+            status = self.tasks.get(task_id)
+            if status is not None and status['state'] not in TERMINAL_STATES:
+                print(f"Task {task_id} lost its worker process")
+                self.tasks.abandon(task_id, json.loads(job).get('fingerprint'),
+                                   'The worker running the job stopped')
+        if expired:
+            self.publish_queue()
+
+    def scratch_limits(self):
+        """Scratch capacity and volume free space in MB, (disk, fast) each"""
+        if self.scratch is None:
+            return (UNLIMITED_MB, UNLIMITED_MB), (UNLIMITED_MB, UNLIMITED_MB)
+        return self.scratch.capacity_mb(), self.scratch.free_mb()
+
+    def admit(self, job):
+        """Move a job from the node's queue to its running jobs if it fits"""
+        self.expire_leases()
+        capacity, free = self.scratch_limits()
+        now = time.time()
+        slots, memory_budget_mb = self.lanes[job.estimate.lane]
+        admitted = self.admit_script(keys=self.keys(job.estimate.lane), args=[
+            job.task.task_id, now, now + LEASE_SECONDS,
+            slots, memory_budget_mb, *capacity, *free])
+        if admitted == -1:
+            # Its lease ran out while Redis was unreachable, queue it again
+            self.register(job)
+        return admitted == 1
+
+    def next_job(self, lane):
+        """Block until one of this process's jobs of a lane can be admitted"""
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                self.prune_cancelled()
+                queued = [job for job in self.queued if job.estimate.lane == lane]
+                if queued:
+                    # Only the job at the head of the lane's queue can be
+                    # admitted, and it's ours if it's our highest priority one
+                    job = min(queued, key=lambda job: job.priority())
+                    if self.admit(job):
+                        self.queued.remove(job)
+                        job.started_at = time.time()
+                        self.running[job.task.task_id] = job
+                        return job
+                # Jobs of other processes finish without notifying us
+                self.condition.wait(timeout=ADMIT_POLL_SECONDS)
+
+    def finish(self, job):
+        self.forget(job.task.task_id)
+        with self.condition:
+            self.running.pop(job.task.task_id, None)
+            self.condition.notify_all()
+        self.publish_queue()
+
+    def work(self, lane='video'):
+        while True:
+            job = self.next_job(lane)
+            if job is None:
+                break
+            try:
+                self.tasks.clear(job.task.task_id, *QUEUE_FIELDS)
+                self.publish_queue()
+                job.task.start()
+                job.task.join()
+            except Exception as e:
+                print(f"Error processing task: {e}")
+            finally:
+                self.finish(job)
+
+    def publish_queue(self):
+        """Store every queued job's position and estimated start time
+
+        Start times come from replaying each lane's queue order over its job
+        slots, using the estimated run time of the running and queued jobs.
+        """
+        _, running_key, jobs_key, _ = self.keys()
+        try:
+            with self.redis_client.pipeline(transaction=True) as pipe:
+                for lane in self.lanes:
+                    pipe.zrange(queue_key(lane), 0, -1)
+                pipe.smembers(running_key)
+                pipe.hgetall(jobs_key)
+                *lane_queues, running_ids, jobs = pipe.execute()
+        except Exception as e:
+            print(f"Error publishing the queue: {e}")
+            return
+        jobs = {task_id.decode(): json.loads(job) for task_id, job in jobs.items()}
+
+        now = time.time()
+        updates = {}
+        for (lane, (lane_slots, _)), queued_ids in zip(self.lanes.items(), lane_queues):
+            slots = []
+            for task_id in running_ids:
+                job = jobs.get(task_id.decode())
+                if job and job.get('lane', 'video') == lane and 'started_at' in job:
+                    slots.append(max(job['started_at'] + job['wall_seconds'] - now, 0))
+            slots += [0] * (lane_slots - len(slots))
+
+            for position, task_id in enumerate(queued_ids, start=1):
+                task_id = task_id.decode()
+                job = jobs.get(task_id)
+                if job is None or not slots:
+                    continue
+                slots.sort()
+                wait = slots[0]
+                slots[0] = wait + job['wall_seconds']
+                updates[task_id] = {
+                    'queue_position': position,
+                    'estimated_start': int(now + wait),
+                }
+        if updates:
+            self.tasks.update_many(updates, event_type='queue')
@@ -0,0 +1,177 @@
+"""
+Scratch space for jobs.
+
+Every job gets a directory on two volumes: SCRATCH_DIR (disk) for videos,
+and SCRATCH_FAST_DIR (tmpfs, /dev/shm by default) for audio and other
+intermediates. A job only uses the fast volume if its estimated audio and
+intermediates fit in its share of it (the volume's size split between the
+job slots), otherwise they stay on disk too. Request handlers write a job's
+inputs straight into its scratch directories, and files move between
+directories by rename, so an input is never copied on its way to the job.
+
+Each job is held to SCRATCH_JOB_QUOTA_MB. The scheduler reserves every
+job's estimated scratch on both volumes. A job is only admitted while the
+reservations fit in SCRATCH_TOTAL_QUOTA_MB on disk and in the size of the
+fast volume. Directories are removed when their job ends, and ones left
+behind by a crashed process are pruned on startup.
+"""
+
+import errno
+import os
+import shutil
+import tempfile
+import time
+
+from scheduler import MAX_CONCURRENT_JOBS
+
+SCRATCH_DIR = os.getenv("SCRATCH_DIR") or os.path.join(
+    tempfile.gettempdir(), 'snipclips-scratch')
+SCRATCH_FAST_DIR = os.getenv("SCRATCH_FAST_DIR") or (
+    '/dev/shm/snipclips-scratch' if os.access('/dev/shm', os.W_OK) else SCRATCH_DIR)
+SCRATCH_JOB_QUOTA_MB = int(os.getenv("SCRATCH_JOB_QUOTA_MB", 2 * 1024))
+SCRATCH_TOTAL_QUOTA_MB = int(os.getenv("SCRATCH_TOTAL_QUOTA_MB", 10 * 1024))
+MB = 1024 * 1024
+
+
+class ScratchQuotaExceeded(Exception):
+    """Raised when a job writes more than its scratch quota"""
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+
+def handoff(src, dest):
+    """Move a file by renaming it, copying only across filesystems"""
+    try:
+        os.replace(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dest)
+    return dest
+
+
+class JobScratch:
+    def __init__(self, space, job_id):
+        self.space = space
+        self.job_id = job_id
+        self.video_dir = os.path.join(space.disk_root, job_id)
+        self.fast_dir = os.path.join(space.fast_root, job_id)
+        for path in self.dirs():
+            os.makedirs(path, exist_ok=True)
+
+    def reserve(self, estimate):
+        """Pick the volume of the job's audio and intermediates from its estimate
+
+        Called before the job writes to its fast directory. The estimate is
+        updated to what the job will hold on each volume.
+        """
+        if self.fast_dir != self.video_dir and self.space.fast_fits(estimate.fast_mb):
+            return
+        if self.fast_dir != self.video_dir:
+            shutil.rmtree(self.fast_dir, ignore_errors=True)
+            self.fast_dir = self.video_dir
+        estimate.keep_on_disk()
+
+    def dirs(self):
+        # Both volumes are the same directory where no tmpfs is available
+        return {self.video_dir, self.fast_dir}
+
+    def video_path(self, name):
+        return os.path.join(self.video_dir, name)
+
+    def fast_path(self, name):
+        return os.path.join(self.fast_dir, name)
+
+    def usage(self):
+        return sum(dir_size(path) for path in self.dirs())
+
+    def check_quota(self):
+        used = self.usage()
+        if used > self.space.job_quota_mb * MB:
+            raise ScratchQuotaExceeded(
+                f'Job used {used // MB}MB of scratch space, '
+                f'the limit is {self.space.job_quota_mb}MB')
+
+    def cleanup(self):
+        for path in self.dirs():
+            shutil.rmtree(path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+
+class ScratchSpace:
+    def __init__(self, disk_root=SCRATCH_DIR, fast_root=SCRATCH_FAST_DIR,
+                 job_quota_mb=SCRATCH_JOB_QUOTA_MB, total_quota_mb=SCRATCH_TOTAL_QUOTA_MB):
+        self.disk_root = disk_root
+        self.fast_root = fast_root
+        self.job_quota_mb = job_quota_mb
+        self.total_quota_mb = total_quota_mb
+        for root in self.roots():
+            os.makedirs(root, exist_ok=True)
+
+    def roots(self):
+        return {self.disk_root, self.fast_root}
+
+    def create(self, job_id):
+        return JobScratch(self, job_id)
+
+    def has_fast_volume(self):
+        return self.fast_root != self.disk_root
+
+    def fast_fits(self, fast_mb):
+        """Whether a job's audio and intermediates fit in its share of the fast volume"""
+        if not self.has_fast_volume():
+            return False
+        return fast_mb * MB <= shutil.disk_usage(self.fast_root).total / MAX_CONCURRENT_JOBS
+
+    def capacity_mb(self):
+        """Scratch the scheduler may reserve on the disk and the fast volume"""
+        fast_mb = shutil.disk_usage(self.fast_root).total // MB if self.has_fast_volume() else 0
+        return self.total_quota_mb, fast_mb
+
+    def free_mb(self):
+        """Free space on the disk and the fast volume"""
+        disk_mb = shutil.disk_usage(self.disk_root).free // MB
+        fast_mb = shutil.disk_usage(self.fast_root).free // MB if self.has_fast_volume() else 0
+        return disk_mb, fast_mb
+
+    def usage(self):
+        """Scratch usage of every job on this node, for monitoring"""
+        disk_free_mb, fast_free_mb = self.free_mb()
+        return {
+            'disk_bytes': dir_size(self.disk_root),
+            'fast_bytes': dir_size(self.fast_root) if self.has_fast_volume() else 0,
+            'jobs': len(set().union(*(os.listdir(root) for root in self.roots()))),
+            'quota_bytes': self.total_quota_mb * MB,
+            'fast_capacity_bytes': self.capacity_mb()[1] * MB,
+            'disk_free_bytes': disk_free_mb * MB,
+            'fast_free_bytes': fast_free_mb * MB,
+        }
+
+    def has_room(self, size=0):
+        """Whether the disk, where inputs and uploads go, has room for `size` bytes"""
+        return shutil.disk_usage(self.disk_root).free > size
+
+    def prune_stale(self, max_age):
+        """Remove job directories not touched for `max_age` seconds"""
+        cutoff = time.time() - max_age
+        for root in self.roots():
+            for entry in os.scandir(root):
+                try:
+                    if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                except FileNotFoundError:
+                    continue
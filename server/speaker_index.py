@@ -0,0 +1,231 @@
+"""
+Cross-video speaker index.
+
+Every processed video adds one row per diarized speaker: the speaker's
+embedding and its turns. A reference voice can then be looked up across all
+indexed videos without diarizing anything again.
+
+Files in SPEAKER_INDEX_DIR:
+
+    embeddings.f32  L2-normalized float32 rows, memory-mapped for search
+    codes.u16       random-hyperplane LSH codes, LSH_TABLES per row
+    entries.jsonl   one line per row (task, source, speaker, turns)
+    index.json      embedding dimension and hyperplane seed
+
+Small indexes are searched exactly. Past EXACT_SEARCH_MAX_ROWS, rows whose
+code is within one bit of the query's in any table are the candidates, and
+only those are scored. Rows are appended under a file lock, entries last,
+so a crashed write is trimmed by the next one.
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+
+from config import MATCH_THRESHOLD
+
+SPEAKER_INDEX_DIR = os.getenv("SPEAKER_INDEX_DIR", os.path.join(
+    tempfile.gettempdir(), 'snipclips-speaker-index'))
+EXACT_SEARCH_MAX_ROWS = 20000
+LSH_TABLES = 16
+LSH_BITS = 10
+LSH_SEED = 1234
+
+
+def normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SpeakerIndex:
+    def __init__(self, root=SPEAKER_INDEX_DIR):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries = []
+        self.entries_offset = 0
+        self.video_ids = set()
+        self.dim = None
+        self.hyperplanes = None
+        self.popcount = None
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    @contextmanager
+    def write_lock(self):
+        """Serialize writers across worker processes"""
+        with open(self.path('index.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load_meta(self, dim=None):
+        if self.dim is not None:
+            return True
+        meta_path = self.path('index.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        elif dim is not None:
+            meta = {'dim': dim, 'seed': LSH_SEED}
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        else:
+            return False
+        self.dim = meta['dim']
+        rng = np.random.default_rng(meta['seed'])
+        self.hyperplanes = rng.standard_normal(
+            (LSH_TABLES, LSH_BITS, self.dim)).astype(np.float32)
+        return True
+
+    def codes(self, vectors):
+        """LSH code of each vector in every table, as uint16"""
+        bits = np.einsum('tbd,nd->ntb', self.hyperplanes, vectors) > 0
+        weights = 1 << np.arange(LSH_BITS, dtype=np.uint16)
+        return (bits * weights).sum(axis=2).astype(np.uint16)
+
+    def refresh(self):
+        """Read the entries appended by any process since the last call"""
+        entries_path = self.path('entries.jsonl')
+        if not os.path.exists(entries_path):
+            return
+        with open(entries_path, 'rb') as f:
+            f.seek(self.entries_offset)
+            data = f.read()
+        # Leave a line that is still being written for the next refresh
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            entry = json.loads(line)
+            self.entries.append(entry)
+            self.video_ids.add(entry['video_id'])
+        self.entries_offset += end
+
+    def trim(self):
+        """Drop rows left behind by an interrupted write, under the write lock"""
+        entries_path = self.path('entries.jsonl')
+        rows = 0
+        if os.path.exists(entries_path):
+            with open(entries_path, 'rb') as f:
+                data = f.read()
+            end = data.rfind(b'\n') + 1
+            rows = data[:end].count(b'\n')
+            if end != len(data):
+                os.truncate(entries_path, end)
+        for name, row_size in (('embeddings.f32', self.dim * 4),
+                               ('codes.u16', LSH_TABLES * 2)):
+            path = self.path(name)
+            if os.path.exists(path) and os.path.getsize(path) > rows * row_size:
+                os.truncate(path, rows * row_size)
+
+    def add_video(self, video_id, task_id, source, turns, embeddings):
+        """Index the speakers of a video, returns False if it was indexed before
+
+        `turns` are (start, end, speaker_label) tuples and `embeddings` maps
+        speaker labels to their embedding.
+        """
+        if not embeddings:
+            return False
+        vectors = {label: normalize(embedding)
+                   for label, embedding in embeddings.items()}
+        dim = len(next(iter(vectors.values())))
+
+        with self.lock, self.write_lock():
+            self.load_meta(dim)
+            if dim != self.dim:
+                raise ValueError(
+                    f'Embedding dimension {dim} does not match the index ({self.dim})')
+            self.refresh()
+            if video_id in self.video_ids:
+                return False
+            self.trim()
+
+            labels = sorted(vectors)
+            matrix = np.stack([vectors[label] for label in labels])
+            with open(self.path('embeddings.f32'), 'ab') as f:
+                f.write(matrix.tobytes())
+            with open(self.path('codes.u16'), 'ab') as f:
+                f.write(self.codes(matrix).tobytes())
+            with open(self.path('entries.jsonl'), 'a') as f:
+                for label in labels:
+                    f.write(json.dumps({
+                        'video_id': video_id,
+                        'task_id': task_id,
+                        'source': source,
+                        'speaker': label,
+                        'turns': [[start, end] for start, end, speaker_label in turns
+                                  if speaker_label == label],
+                    }) + '\n')
+            self.refresh()
+        return True
+
+    def candidates(self, codes, query):
+        """Rows within one bit of the query's code in at least one table"""
+        if self.popcount is None:
+            self.popcount = np.array(
+                [bin(value).count('1') for value in range(1 << LSH_BITS)],
+                dtype=np.uint8)
+        query_codes = self.codes(query[np.newaxis])[0]
+        mismatches = self.popcount[codes ^ query_codes]
+        return np.flatnonzero((mismatches <= 1).any(axis=1))
+
+    def search(self, embedding, threshold=MATCH_THRESHOLD, limit=20):
+        """Rank the indexed videos by their closest speaker to `embedding`"""
+        with self.lock:
+            if not self.load_meta():
+                return [], 0
+            self.refresh()
+            rows = len(self.entries)
+            entries = self.entries[:rows]
+        if not rows:
+            return [], 0
+
+        query = normalize(embedding)
+        if len(query) != self.dim:
+            raise ValueError(
+                f'Embedding dimension {len(query)} does not match the index ({self.dim})')
+        vectors = np.memmap(self.path('embeddings.f32'), dtype=np.float32,
+                            mode='r', shape=(rows, self.dim))
+        if rows > EXACT_SEARCH_MAX_ROWS:
+            codes = np.memmap(self.path('codes.u16'), dtype=np.uint16,
+                              mode='r', shape=(rows, LSH_TABLES))
+            row_ids = self.candidates(codes, query)
+        else:
+            row_ids = np.arange(rows)
+        distances = 1.0 - vectors[row_ids] @ query
+
+        videos = {}
+        for row_id, distance in zip(row_ids, distances):
+            if distance > threshold:
+                continue
+            entry = entries[row_id]
+            video = videos.setdefault(entry['video_id'], {
+                'video_id': entry['video_id'],
+                'task_id': entry['task_id'],
+                'source': entry['source'],
+                'distance': float(distance),
+                'speakers': [],
+                'time_ranges': [],
+            })
+            video['distance'] = min(video['distance'], float(distance))
+            video['speakers'].append(entry['speaker'])
+            video['time_ranges'].extend(entry['turns'])
+
+        results = sorted(videos.values(), key=lambda video: video['distance'])[:limit]
+        for video in results:
+            video['time_ranges'].sort()
+        return results, rows
+
+
+@lru_cache(maxsize=None)
+def get_speaker_index():
+    return SpeakerIndex()
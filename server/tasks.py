@@ -0,0 +1,333 @@
+"""
+Task state storage.
+
+Each task is a Redis hash at `task:{id}` so progress updates only rewrite
+the fields that changed. Every write refreshes the key's TTL: running tasks
+are kept for TASK_TTL, finished ones for TASK_SUCCESS_TTL / TASK_FAILURE_TTL.
+Writes (and the matching pub/sub event) go out in a single pipeline.
+"""
+
+import hashlib
+import json
+import os
+
+from progress import publish_event
+
+TASK_TTL = int(os.getenv("TASK_TTL", 24 * 60 * 60))  # 1 day
+TASK_SUCCESS_TTL = int(os.getenv("TASK_SUCCESS_TTL", 7 * 24 * 60 * 60))  # 7 days
+TASK_FAILURE_TTL = int(os.getenv("TASK_FAILURE_TTL", 24 * 60 * 60))  # 1 day
+MAX_BATCH_STATUS = 100  # task ids per batch status request
+TERMINAL_STATES = {'SUCCESS', 'FAILURE', 'CANCELLED'}
+QUEUE_FIELDS = ('queue_position', 'estimated_start')
+
+# Fields stored as JSON, everything else is kept as a plain string
+JSON_FIELDS = {'result', 'task_ids'}
+INT_FIELDS = {'percentage', 'queue_position', 'estimated_start',
+              'estimated_cpu_seconds', 'estimated_memory_mb', 'estimated_scratch_mb',
+              'cancel_requested', 'videos_total', 'videos_done', 'videos_failed',
+              'rejected', 'attachments'}
+
+
+# Delete the in-flight key only if it still points at the finishing task
+RELEASE_INFLIGHT_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+# Attach another client to an unfinished task, unless a cancel is pending
+ATTACH_SCRIPT = """
+if redis.call('hexists', KEYS[1], 'cancel_requested') == 1 then
+    return 0
+end
+local state = redis.call('hget', KEYS[1], 'state')
+if not state or state == 'SUCCESS' or state == 'FAILURE' or state == 'CANCELLED' then
+    return 0
+end
+redis.call('hincrby', KEYS[1], 'attachments', 1)
+return 1
+"""
+
+# Detach a client, and request a cancel once no client is left. ARGV[1]
+# is '1' when the last client rejected the task's preview
+DETACH_SCRIPT = """
+local left = redis.call('hincrby', KEYS[1], 'attachments', -1)
+if left <= 0 then
+    redis.call('hset', KEYS[1], 'cancel_requested', 1)
+    if ARGV[1] == '1' then
+        redis.call('hset', KEYS[1], 'rejected', 1)
+    end
+end
+return left
+"""
+
+
+class TaskCancelled(Exception):
+    """Raised inside a running job once a cancel has been requested"""
+
+
+def task_key(task_id):
+    return f"task:{task_id}"
+
+
+def analysis_key(task_id):
+    return f"analysis:{task_id}"
+
+
+def inflight_key(fingerprint):
+    return f"inflight:{fingerprint}"
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def params_fingerprint(**parts):
+    key = json.dumps(parts, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def job_fingerprint(youtube_url=None, video_file_path=None, reference_audio_path=None, params=None):
+    """Identify a submission by its input contents and parameters"""
+    video = youtube_url.strip() if youtube_url else file_digest(video_file_path)
+    return params_fingerprint(
+        video=video,
+        reference=file_digest(reference_audio_path),
+        params=params or {}
+    )
+
+
+def encode_fields(fields):
+    return {
+        key: json.dumps(value) if key in JSON_FIELDS else value
+        for key, value in fields.items()
+        if value is not None
+    }
+
+
+def decode_task(raw):
+    """Turn a task hash from Redis into the status dict returned to clients"""
+    if not raw:
+        return None
+    task = {}
+    for key, value in raw.items():
+        key = key.decode()
+        value = value.decode()
+        if key in JSON_FIELDS:
+            value = json.loads(value)
+        elif key in INT_FIELDS:
+            value = int(value)
+        task[key] = value
+    return task
+
+
+class TaskStore:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def write(self, task_id, fields, ttl=TASK_TTL, event_type=None, replace=False, remove=()):
+        """Update task fields, refresh the TTL and optionally publish an event"""
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            if replace:
+                pipe.delete(task_key(task_id))
+            if remove:
+                pipe.hdel(task_key(task_id), *remove)
+            pipe.hset(task_key(task_id), mapping=encode_fields(fields))
+            pipe.expire(task_key(task_id), ttl)
+            if event_type:
+                publish_event(pipe, task_id, fields, type=event_type)
+            pipe.execute()
+
+    def update_many(self, updates, event_type='progress'):
+        """Update the fields of several tasks in one pipeline"""
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_id, fields in updates.items():
+                pipe.hset(task_key(task_id), mapping=encode_fields(fields))
+                pipe.expire(task_key(task_id), TASK_TTL)
+                if event_type:
+                    publish_event(pipe, task_id, fields, type=event_type)
+            pipe.execute()
+
+    def clear(self, task_id, *fields):
+        self.redis_client.hdel(task_key(task_id), *fields)
+
+    def create(self, task_id, **fields):
+        self.write(task_id, {'state': 'PENDING', **fields}, replace=True)
+
+    def update(self, task_id, event_type='progress', **fields):
+        self.write(task_id, fields, event_type=event_type)
+
+    def finish(self, task_id, result):
+        self.write(task_id, {'state': 'SUCCESS', 'result': result},
+                   ttl=TASK_SUCCESS_TTL, event_type='success',
+                   remove=QUEUE_FIELDS)
+
+    def fail(self, task_id, error):
+        self.write(task_id, {'state': 'FAILURE', 'error': error},
+                   ttl=TASK_FAILURE_TTL, event_type='failure',
+                   remove=QUEUE_FIELDS)
+
+    def cancel(self, task_id):
+        fields = {'state': 'CANCELLED'}
+        # Clients tell a rejected preview apart from a cancel
+        if self.redis_client.hexists(task_key(task_id), 'rejected'):
+            fields['rejected'] = 1
+        self.write(task_id, fields,
+                   ttl=TASK_FAILURE_TTL, event_type='cancelled',
+                   remove=QUEUE_FIELDS)
+
+    def save_analysis(self, task_id, turns, distances, source_task_id):
+        """Keep a task's speaker turns and distances for re-cuts"""
+        self.redis_client.set(analysis_key(task_id), json.dumps({
+            'turns': turns,
+            'speaker_distances': distances,
+            'source_task_id': source_task_id,
+        }), ex=TASK_SUCCESS_TTL)
+
+    def get_analysis(self, task_id):
+        analysis = self.redis_client.get(analysis_key(task_id))
+        return json.loads(analysis) if analysis else None
+
+    def request_cancel(self, task_id):
+        self.redis_client.hset(task_key(task_id), 'cancel_requested', 1)
+
+    def attach(self, task_id):
+        """Add a client to a deduplicated task, False if it's finishing or cancelled"""
+        return bool(self.redis_client.eval(ATTACH_SCRIPT, 1, task_key(task_id)))
+
+    def detach(self, task_id, rejected=False):
+        """Remove a client from a task, returns how many are still attached
+
+        A cancel is requested once none are left. Tasks created without an
+        `attachments` count have a single owner.
+        """
+        return self.redis_client.eval(DETACH_SCRIPT, 1, task_key(task_id),
+                                      int(rejected))
+
+    def reject(self, task_id):
+        """Detach a client that rejected the task's preview
+
+        The job stops once no other client is attached, its analysis stays
+        for re-cuts. Returns how many clients are still attached.
+        """
+        return self.detach(task_id, rejected=True)
+
+    def cancel_requested(self, task_id):
+        return self.redis_client.hexists(task_key(task_id), 'cancel_requested')
+
+    def cancelled_among(self, task_ids):
+        """Return the ids among `task_ids` with a pending cancel request"""
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hexists(task_key(task_id), 'cancel_requested')
+            flags = pipe.execute()
+        return {task_id for task_id, flag in zip(task_ids, flags) if flag}
+
+    def claim_inflight(self, fingerprint, task_id):
+        """Register a new task for a fingerprint
+
+        Returns the id of an unfinished task already registered for the same
+        fingerprint, after attaching the caller to it, or None if `task_id`
+        now owns it.
+        """
+        key = inflight_key(fingerprint)
+        while True:
+            if self.redis_client.set(key, task_id, nx=True, ex=TASK_TTL):
+                return None
+            existing = self.redis_client.get(key)
+            if existing is None:
+                continue
+            existing = existing.decode()
+            if self.attach(existing):
+                return existing
+            # The previous task is gone, being cancelled or finished without
+            # releasing the key
+            self.redis_client.set(key, task_id, ex=TASK_TTL)
+            return None
+
+    def release_inflight(self, fingerprint, task_id):
+        self.redis_client.eval(RELEASE_INFLIGHT_SCRIPT, 1,
+                               inflight_key(fingerprint), task_id)
+
+    def abandon(self, task_id, fingerprint, error):
+        """Fail a task that will never run, so duplicates stop attaching to it"""
+        self.fail(task_id, error)
+        if fingerprint:
+            self.release_inflight(fingerprint, task_id)
+
+    def delete(self, task_id):
+        self.redis_client.delete(task_key(task_id))
+
+    def get(self, task_id):
+        return decode_task(self.redis_client.hgetall(task_key(task_id)))
+
+    def get_many(self, task_ids):
+        """Fetch the state of several tasks in a single round-trip"""
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hgetall(task_key(task_id))
+            results = pipe.execute()
+        return {
+            task_id: decode_task(raw)
+            for task_id, raw in zip(task_ids, results)
+        }
+
+
+class AsyncTaskStore:
+    """Read-only task store for the ASGI app's async Redis client"""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    async def get(self, task_id):
+        return decode_task(await self.redis_client.hgetall(task_key(task_id)))
+
+    async def get_many(self, task_ids):
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hgetall(task_key(task_id))
+            results = await pipe.execute()
+        return {
+            task_id: decode_task(raw)
+            for task_id, raw in zip(task_ids, results)
+        }
+
+
+# The status routes are served by both the Flask and the ASGI app, these
+# helpers keep their responses the same
+
+def task_status_response(status):
+    """Body of a single task status response, unknown tasks are still pending"""
+    return status or {'state': 'PENDING'}
+
+
+def parse_batch_status_request(body):
+    """Task ids of a batch status request body, or an error message"""
+    if not isinstance(body, dict):
+        body = {}
+    return validate_task_ids(body.get('task_ids'))
+
+
+def batch_status_response(statuses):
+    return {'tasks': {
+        task_id: task_status_response(status)
+        for task_id, status in statuses.items()
+    }}
+
+
+def validate_task_ids(task_ids):
+    """Validate the task ids of a batch status request"""
+    if not isinstance(task_ids, list) or not task_ids:
+        return None, 'task_ids must be a non-empty list'
+    if len(task_ids) > MAX_BATCH_STATUS:
+        return None, f'At most {MAX_BATCH_STATUS} task ids per request'
+    if not all(isinstance(task_id, str) for task_id in task_ids):
+        return None, 'task_ids must be strings'
+    # Keep the order but drop duplicates
+    return list(dict.fromkeys(task_ids)), None
@@ -0,0 +1,66 @@
+"""
+Resumable upload sessions.
+
+Large video files can be sent ahead of a /process_video request in chunks
+through the ASGI server. The session state lives in Redis so any worker can
+serve the next chunk, and the finished file is handed to the job by id.
+The files of sessions that expire without being claimed are removed when
+the next session is opened.
+"""
+
+import os
+import tempfile
+import time
+
+from scratch import handoff
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(
+    tempfile.gettempdir(), 'snipclips-uploads'))
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", 60 * 60))  # 1 hour
+# Files are created just before their session, leave new ones alone
+UPLOAD_PRUNE_GRACE = 60
+
+
+def upload_key(upload_id):
+    return f"upload:{upload_id}"
+
+
+def upload_path(upload_id):
+    return os.path.join(UPLOAD_DIR, upload_id)
+
+
+def stale_uploads(min_age=UPLOAD_PRUNE_GRACE):
+    """Ids of the upload files not written to for `min_age` seconds"""
+    if not os.path.isdir(UPLOAD_DIR):
+        return []
+    cutoff = time.time() - min_age
+    upload_ids = []
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    upload_ids.append(entry.name)
+            except FileNotFoundError:
+                continue
+    return upload_ids
+
+
+def claim_upload(redis_client, upload_id, dest_dir):
+    """Move a completed upload into `dest_dir` and return its new path"""
+    session = redis_client.hgetall(upload_key(upload_id))
+    if not session:
+        raise ValueError('Unknown or expired upload session')
+
+    size = int(session[b'size'])
+    received = int(session[b'received'])
+    if received != size:
+        raise ValueError(
+            f'Upload is incomplete ({received} of {size} bytes received)')
+
+    filename = session[b'filename'].decode()
+    dest_path = os.path.join(dest_dir, filename)
+    # Drop any bytes left behind by an interrupted chunk past the end
+    os.truncate(upload_path(upload_id), size)
+    handoff(upload_path(upload_id), dest_path)
+    redis_client.delete(upload_key(upload_id))
+    return dest_path